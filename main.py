@@ -15,230 +15,152 @@ Tagify v8.1 — 图片标签管理系统
   - #10 处理线程改为非 daemon，App 关闭时发送停止信号并等待线程结束
 """
 
+import os
+import sys
+import threading
 import tkinter as tk
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from tkinter import ttk, messagebox
-from PIL import Image, ImageTk, ImageFile, ImageDraw
-import sqlite3
-import os
-import shutil
-import threading
-import numpy as np
-from datetime import datetime
-from collections import OrderedDict
-import win32clipboard
-import torch
-import timm
-import pandas as pd
-import json
-from safetensors.torch import load_file
-
-# ── 应用配置加载 ──────────────────────────────────────────
-APP_CONFIG_PATH = 'app_config.json'
-
-def _load_config():
-    """加载 app_config.json，缺失时使用内置默认值"""
-    defaults = {
-        "paths": {
-            "model_path": "model.safetensors",
-            "config_path": "config.json",
-            "tags_csv": "selected_tags.csv",
-            "input_folder": "input_image",
-            "archive_folder": "../deepdanbooru-v3-20211112-sgd-e28 (1)/gallery",
-            "db_file": "image_tags.db"
-        },
-        "model": {
-            "image_size": [448, 448],
-            "default_threshold": 0.5,
-            "process_threshold": 0.05,
-            "main_tag_threshold": 0.5,
-            "detail_tag_min": 0.05,
-            "valid_extensions": [".png", ".jpg", ".jpeg", ".webp"],
-            "load_truncated_images": True
-        },
-        "ui": {
-            "window_size": [1400, 800],
-            "panel_widths": [300, 700, 400],
-            "thumbnail_size": [150, 150],
-            "thumbnail_cache_max": 500,
-            "page_size": 20,
-            "default_columns": 4,
-            "thumbnail_padding": 20,
-            "search_entry_width": 22,
-            "tag_button_width": 280,
-            "tag_tree_height": 15,
-            "tag_column_width": 150,
-            "confidence_column_width": 80,
-            "tree_row_height_main": 25,
-            "tree_row_height_detail": 20,
-            "detail_image_max_size": [800, 800],
-            "detail_window_ratio": 0.8,
-            "info_label_width": 8,
-            "pagination_frame_height": 40,
-            "info_frame_width": 380,
-            "colors": {
-                "main_bg": "#f5f5f5",
-                "accent": "#c8ccd0",
-                "detail_bg": "#fafafa"
-            }
-        },
-        "behavior": {
-            "favorite_tag": "collect",
-            "default_sort": "time",
-            "default_order": "DESC",
-            "shutdown_timeout": 3,
-            "pagination_side": 4
-        }
-    }
-
-    try:
-        with open(APP_CONFIG_PATH, 'r', encoding='utf-8') as f:
-            user_cfg = json.load(f)
-        for section in user_cfg:
-            if section in defaults and isinstance(user_cfg[section], dict):
-                defaults[section].update(user_cfg[section])
-        print(f"已加载配置: {APP_CONFIG_PATH}")
-    except FileNotFoundError:
-        print(f"未找到 {APP_CONFIG_PATH}，使用默认配置")
-    except json.JSONDecodeError as e:
-        print(f"配置文件解析失败: {e}，使用默认配置")
-
-    return defaults
-
-_cfg = _load_config()
-_p = _cfg["paths"]
-_m = _cfg["model"]
-_u = _cfg["ui"]
-_b = _cfg["behavior"]
-
-# ── 路径 ──
-MODEL_PATH   = _p["model_path"]
-CONFIG_PATH  = _p["config_path"]
-TAGS_CSV_PATH = _p["tags_csv"]
-INPUT_FOLDER = _p["input_folder"]
-DB_FILE      = _p["db_file"]
-
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-ARCHIVE_FOLDER = os.path.normpath(os.path.join(SCRIPT_DIR, _p["archive_folder"]))
-os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
-
-# ── 模型 ──
-IMAGE_SIZE       = tuple(_m["image_size"])
-DEFAULT_THRESHOLD = _m["default_threshold"]
-PROCESS_THRESHOLD = _m["process_threshold"]
-MAIN_TAG_THRESHOLD = _m["main_tag_threshold"]
-DETAIL_TAG_MIN    = _m["detail_tag_min"]
-VALID_EXTENSIONS  = tuple(_m["valid_extensions"])
-ImageFile.LOAD_TRUNCATED_IMAGES = _m["load_truncated_images"]
-
-# ── UI ──
-WINDOW_SIZE      = f"{_u['window_size'][0]}x{_u['window_size'][1]}"
-PANEL_LEFT_W     = _u["panel_widths"][0]
-PANEL_CENTER_W   = _u["panel_widths"][1]
-PANEL_RIGHT_W    = _u["panel_widths"][2]
-THUMB_SIZE       = tuple(_u["thumbnail_size"])
-THUMB_CACHE_MAX  = _u["thumbnail_cache_max"]
-PAGE_SIZE        = _u["page_size"]
-DEFAULT_COLUMNS  = _u["default_columns"]
-THUMB_PADDING    = _u["thumbnail_padding"]
-SEARCH_ENTRY_W   = _u["search_entry_width"]
-TAG_BUTTON_W     = _u["tag_button_width"]
-TAG_TREE_HEIGHT  = _u["tag_tree_height"]
-TAG_COL_W        = _u["tag_column_width"]
-CONF_COL_W       = _u["confidence_column_width"]
-TREE_ROW_MAIN    = _u["tree_row_height_main"]
-TREE_ROW_DETAIL  = _u["tree_row_height_detail"]
-DETAIL_IMG_MAX   = tuple(_u["detail_image_max_size"])
-DETAIL_WIN_RATIO = _u["detail_window_ratio"]
-INFO_LABEL_W     = _u["info_label_width"]
-PAGINATION_H     = _u["pagination_frame_height"]
-INFO_FRAME_W     = _u["info_frame_width"]
-MAIN_COLOR       = _u["colors"]["main_bg"]
-ACCENT_COLOR     = _u["colors"]["accent"]
-DETAIL_COLOR     = _u["colors"]["detail_bg"]
-
-# ── 行为 ──
-FAVORITE_TAG     = _b["favorite_tag"]
-DEFAULT_SORT     = _b["default_sort"]
-DEFAULT_ORDER    = _b["default_order"]
-SHUTDOWN_TIMEOUT = _b["shutdown_timeout"]
-PAGINATION_SIDE  = _b["pagination_side"]
-
-
-# ── 模型封装 ──────────────────────────────────────────────
-class WDTagger:
-    """WD ViT Tagger v3 模型封装类"""
-
-    def __init__(self, model_path=MODEL_PATH, config_path=CONFIG_PATH, csv_path=TAGS_CSV_PATH):
-        print("正在初始化新模型...")
-
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        print(f"使用设备: {self.device}")
-
-        with open(config_path, 'r', encoding='utf-8') as f:
-            self.config = json.load(f)
-
-        self.model = timm.create_model(
-            self.config['architecture'],
-            pretrained=False,
-            num_classes=self.config['num_classes'],
-            **self.config['model_args']
-        )
-
-        state_dict = load_file(model_path)
-        self.model.load_state_dict(state_dict)
-        self.model = self.model.to(self.device)
-        self.model.eval()
-
-        self.df = pd.read_csv(csv_path)
-        self.tags = self.df['name'].tolist()
-
-        print(f"模型加载成功！标签数量: {len(self.tags)}")
 
-    def preprocess(self, image):
-        """预处理图片"""
-        image = image.resize(IMAGE_SIZE, Image.Resampling.BICUBIC)
-        img_array = np.array(image).astype(np.float32) / 255.0
-
-        mean = np.array([0.5, 0.5, 0.5], dtype=np.float32)
-        std = np.array([0.5, 0.5, 0.5], dtype=np.float32)
-        img_array = (img_array - mean) / std
-
-        img_tensor = torch.from_numpy(img_array).permute(2, 0, 1)
-        img_tensor = img_tensor.unsqueeze(0)
-        return img_tensor.to(self.device)
-
-    def predict(self, image, threshold=DEFAULT_THRESHOLD):
-        """预测图片标签"""
-        input_tensor = self.preprocess(image)
-
-        with torch.no_grad():
-            outputs = self.model(input_tensor)
-            probs = torch.sigmoid(outputs).cpu().numpy()[0]
-
-        tag_confidences = [(self.tags[i], float(prob))
-                           for i, prob in enumerate(probs) if prob > threshold]
-        return tag_confidences
+import win32clipboard
+from PIL import Image, ImageTk, ImageDraw
+
+# 配置、数据库、索引、模型与入库流程都在 tagify.py（不依赖界面，也可用 python -m tagify 无界面运行）
+from tagify import (
+    # 配置
+    ACCENT_COLOR, ARCHIVE_FOLDER, BITMAP_INDEX, BROWSE_MODE, CONF_COL_W, DEFAULT_COLUMNS, DEFAULT_ORDER,
+    DEFAULT_SORT, DETAIL_COLOR, DETAIL_IMG_MAX, DETAIL_TAG_MIN, DETAIL_WIN_RATIO, FAVORITE_TAG, IMAGE_SIZE,
+    INFO_FRAME_W, INFO_LABEL_W, INPUT_FOLDER, MAIN_COLOR, MAIN_TAG_THRESHOLD, PAGE_SIZE, PAGINATION_H,
+    PAGINATION_MODE, PAGINATION_SIDE, PANEL_CENTER_W, PANEL_LEFT_W, PANEL_RIGHT_W, PREFETCH_BUDGET,
+    PREFETCH_PAGES, PROCESS_THRESHOLD, REDUCING_GAP, RESIZE_DEBOUNCE, SCROLL_OVERSCAN, SEARCH_DEBOUNCE,
+    SEARCH_ENTRY_W, SEARCH_LIMIT, SHUTDOWN_TIMEOUT, SIMILAR_TOP_K, TAG_BUTTON_W, TAG_COL_W, TAG_TREE_HEIGHT,
+    THUMB_BYTES, THUMB_CACHE_BYTES, THUMB_PADDING, THUMB_SIZE, THUMB_WORKERS, TREE_ROW_DETAIL, TREE_ROW_MAIN,
+    WATCH_ON_START, WINDOW_SIZE,
+    # 数据库与索引
+    SQL, ConnectionManager, QueryTimer, SimilarityIndex, TagBitmapIndex, TagIndex, TagQuery, ThumbnailStore,
+    open_embed_store, page_anchor, page_query, prepare_database, repair_archive,
+    # 模型与入库
+    IngestEngine, WDTagger, open_image,
+    # 维护命令（旧版命令行参数）
+    backfill_hashes, explain_queries, rebuild_tag_stats_command, rethreshold,
+)
+
+
+# ── 缩略图内存缓存 ────────────────────────────────────────
+
+class ThumbnailCache:
+    """按字节计量的两级内存缩略图缓存
+
+    raw 层: 图片名 → 原始像素 (mode, size, bytes)，按像素缓冲区大小计量，超出
+            max_bytes 时按 LRU 逐出；线程安全，后台解码线程可直接写入。
+    live 层: 只为当前显示中的图片保留 Tk PhotoImage（retain() 之外的随即释放），
+            只能在主线程访问。
+    """
+
+    def __init__(self, max_bytes=THUMB_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._raw = OrderedDict()
+        self._live = {}
+        self._prefetched = set()        # 由预取写入、尚未被访问过的图片名
+        self._stats = Counter()
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._raw or name in self._live
+
+    def __len__(self):
+        return len(self._raw)
+
+    def put(self, name, image):
+        """写入 PIL 缩略图；刚写入的条目本身不会被逐出"""
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+        entry = (image.mode, image.size, image.tobytes())
+
+        with self._lock:
+            old = self._raw.pop(name, None)
+            if old is not None:
+                self.bytes -= len(old[2])
+            self._raw[name] = entry
+            self.bytes += len(entry[2])
+
+            while self.bytes > self.max_bytes and len(self._raw) > 1:
+                evicted, (_, _, data) = self._raw.popitem(last=False)
+                self.bytes -= len(data)
+                self._stats['evictions'] += 1
+                if evicted in self._prefetched:
+                    self._prefetched.discard(evicted)
+                    self._stats['prefetch_wasted'] += 1
+
+    def photo(self, name, count=True):
+        """主线程: 取 PhotoImage，必要时由 raw 层像素生成；未命中返回 None
+
+        count=False 用于异步加载完成后的回填，不计入命中统计。
+        """
+        with self._lock:
+            entry = self._raw.get(name)
+            if entry is not None:
+                self._raw.move_to_end(name)
+            elif name not in self._live:
+                self._stats['misses'] += count
+                return None
+
+            self._stats['hits'] += count
+            if count and name in self._prefetched:
+                self._prefetched.discard(name)
+                self._stats['prefetch_hits'] += 1
+
+        photo = self._live.get(name)
+        if photo is None:
+            mode, size, data = entry
+            photo = self._live[name] = ImageTk.PhotoImage(Image.frombytes(mode, size, data))
+        return photo
+
+    def retain(self, names):
+        """live 层只保留 names 对应的 PhotoImage（当前屏幕上的图片）"""
+        keep = set(names)
+        for name in [n for n in self._live if n not in keep]:
+            del self._live[name]
+
+    def mark_prefetched(self, name):
+        with self._lock:
+            if name in self._raw:
+                self._prefetched.add(name)
+
+    def discard(self, name):
+        self._live.pop(name, None)
+        with self._lock:
+            entry = self._raw.pop(name, None)
+            if entry is not None:
+                self.bytes -= len(entry[2])
+            self._prefetched.discard(name)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(entries=len(self._raw), bytes=self.bytes, live=len(self._live))
+        return stats
 
 
 # ── GUI 组件 ──────────────────────────────────────────────
 
 class ThumbnailButton(tk.Frame):
-    """自定义缩略图按钮"""
+    """自定义缩略图按钮（可通过 bind_item() 复用于其他图片）"""
 
     def __init__(self, master, image, name, click_command, dblclick_command, context_menu_command):
         super().__init__(master, bg=MAIN_COLOR, padx=5, pady=5)
-        self.click_command = click_command
-        self.dblclick_command = dblclick_command
         self.context_menu_command = context_menu_command
-        self.image_name = name
 
-        self.img_label = tk.Label(self, image=image, bg=MAIN_COLOR)
-        self.img_label.image = image
+        self.img_label = tk.Label(self, bg=MAIN_COLOR)
         self.img_label.pack()
 
-        short_name = name[:18] + "..." if len(name) > 20 else name
-        tk.Label(self, text=short_name, bg=MAIN_COLOR, fg="black", font=('微软雅黑', 8)).pack()
+        self.name_label = tk.Label(self, bg=MAIN_COLOR, fg="black", font=('微软雅黑', 8))
+        self.name_label.pack()
+
+        self.bind_item(image, name, click_command, dblclick_command)
 
         self.img_label.bind("<Button-1>", self.on_click)
         self.img_label.bind("<Double-Button-1>", self.on_dblclick)
@@ -246,6 +168,21 @@ class ThumbnailButton(tk.Frame):
         self.bind("<Enter>", self.on_enter)
         self.bind("<Leave>", self.on_leave)
 
+    def bind_item(self, image, name, click_command, dblclick_command):
+        """绑定到另一张图片：只替换图片、名称与回调，不重建控件"""
+        self.click_command = click_command
+        self.dblclick_command = dblclick_command
+        self.image_name = name
+        self.set_image(image)
+
+        short_name = name[:18] + "..." if len(name) > 20 else name
+        self.name_label.config(text=short_name)
+
+    def set_image(self, image):
+        """替换显示的缩略图（异步加载完成后由主线程调用）"""
+        self.img_label.config(image=image)
+        self.img_label.image = image
+
     def on_click(self, event):
         self.click_command()
 
@@ -340,7 +277,8 @@ class App(tk.Tk):
         self.current_page = 1
         self.page_size = PAGE_SIZE
         self.total_pages = 0
-        self.current_tag = None
+        self.current_tag = None         # 查询视图下为规范化后的查询文本
+        self.current_query = None
         self.selected_image = None
         self.view_mode = "tag"
         self.columns_per_row = DEFAULT_COLUMNS
@@ -348,15 +286,68 @@ class App(tk.Tk):
         self.sort_by = DEFAULT_SORT
         self.sort_order = DEFAULT_ORDER
 
-        # LRU 缩略图缓存 (#5 修复)
-        self.thumbnail_cache = OrderedDict()
+        # 缩略图按钮池: 翻页、排序、调整列数时复用同一批控件
+        self._thumb_pool = []
+        self._visible_thumbs = 0
+        self._empty_label = None
+        self._empty_text = ""
+        self._resize_job = None
+
+        # 滚动浏览: 只为视口内的行（加上下 SCROLL_OVERSCAN 行）放置控件，
+        # 行数据按页从数据库按键集读取，只保留视口附近的几页
+        self.browse_mode = BROWSE_MODE
+        self._scroll_pool = []          # (按钮, 画布窗口项)，第 i 张图片使用 i % len 号控件
+        self._scroll_blocks = OrderedDict()     # 页码 → 图片名列表（LRU）
+        self._scroll_total = 0
+        self._scroll_key = None
+        self._scroll_row_h = None
+        self._scroll_job = None
+        self._scroll_empty = None
+        self._scroll_status = None
+
+        # 分页缓存: 总数按 (视图, 标签) 缓存，页边界按 (视图, 标签, 排序, 方向) 缓存；写库后清空
+        self._count_cache = {}
+        self._page_anchors = {}
+        self._facet_cache = {}          # (视图, 标签) → 结果中的常见标签，同样在写库后清空
+
+        # 缩略图内存缓存 (#5 修复: 现按字节预算逐出)，未命中时再查磁盘缓存
+        self.thumbnail_cache = ThumbnailCache(THUMB_CACHE_BYTES)
+        self.thumb_store = ThumbnailStore()
+
+        # 异步缩略图: 后台线程解码，主线程通过 after() 替换占位图
+        self._thumb_executor = ThreadPoolExecutor(max_workers=THUMB_WORKERS)
+        self._thumb_generation = 0      # 每次 load_images() 递增，作废过期的预取调度
+        self._pending_thumbs = {}       # 图片名 → 解码中的 Future（当前页与预取共用，避免重复解码）
+        self._thumb_waiters = {}        # 图片名 → 当前页上等待该缩略图的按钮
+        self._prefetch_names = set()    # 最近一轮预取提交的图片名
+        self._thumb_stats = Counter()
+        self._thumb_stats_lock = threading.Lock()
+        self._placeholder_thumb = None
+
+        # 标签搜索索引: init_database() 时从数据库载入，搜索框输入时直接查询
+        self.tag_index = TagIndex()
+        self._search_job = None
+
+        # 标签位图索引（需安装 pyroaring）: 查询计数与分面统计
+        self.tag_bitmaps = TagBitmapIndex() if BITMAP_INDEX else None
+
+        # 嵌入向量库（可选）与相似图片索引（首次查找相似图片时载入）
+        self.embed_store = None
+        self.similarity_index = None
+        self.current_similar = []
+        self._similar_request = None    # 后台查找中的图片名
 
         # 打开的原图窗口追踪 (#9 修复)
         self.detail_windows = {}
 
+        # 数据库连接: 界面线程长期持有读连接（保留页缓存和预编译语句），入库线程用单独的写连接
+        self.query_timer = QueryTimer()
+        self.db = ConnectionManager(on_query=self.query_timer)
+
         # 线程停止信号 (#10 修复)
         self._stop_event = threading.Event()
         self._worker_thread = None
+        self._watching = False
 
         # ── 加载模型 (#4 修复: 移到 __init__ 内并包裹异常处理) ──
         self.tagger = None
@@ -373,6 +364,20 @@ class App(tk.Tk):
                 "程序将以离线模式运行（无法处理新图片）。"
             ))
 
+        # 入库引擎（模型加载成功时创建），界面只负责启动处理线程和显示进度
+        self.engine = None
+        if self.tagger is not None:
+            self.engine = IngestEngine(
+                self.tagger, self.thumb_store, db=self.db, stop_event=self._stop_event,
+                on_progress=self._on_engine_progress, on_error=self.log_error,
+                on_batch=lambda: self.after(0, self._invalidate_page_cache))
+            self.engine.tag_index = self.tag_index
+            self.engine.tag_bitmaps = self.tag_bitmaps
+            self.embed_store = self.engine.embed_store
+        else:
+            # 离线模式下仍可用已保存的向量查找相似图片
+            self.embed_store = open_embed_store()
+
         self.init_ui()
         self.init_database()
 
@@ -386,14 +391,34 @@ class App(tk.Tk):
         # 注册窗口关闭回调 (#10 修复)
         self.protocol("WM_DELETE_WINDOW", self._on_app_close)
 
+        if WATCH_ON_START and self.engine is not None:
+            self.after(0, self.toggle_watch)
+
     # ── 窗口关闭处理 (#10 修复) ──
     def _on_app_close(self):
         """优雅关闭：通知工作线程停止，等待最多 3 秒"""
         if self._worker_thread and self._worker_thread.is_alive():
             self._stop_event.set()
             self._worker_thread.join(timeout=SHUTDOWN_TIMEOUT)
+        # 不等待正在解码的任务: 它们回调 after() 需要主线程，等待会互相阻塞
+        self._cancel_thumbnail_requests()
+        self._thumb_executor.shutdown(wait=False)
+        self.thumb_store.close()
+        self.save_bitmap_index()
+        # 工作线程未能按时退出时仍在使用写连接，交给进程退出处理
+        if not (self._worker_thread and self._worker_thread.is_alive()):
+            self.db.close()
         self.destroy()
 
+    def save_bitmap_index(self):
+        """有未保存的改动时写出标签位图索引（处理结束和关闭窗口时调用）"""
+        if self.tag_bitmaps is None or not self.tag_bitmaps.dirty:
+            return
+        try:
+            self.tag_bitmaps.save(self.db.reader.cursor())
+        except Exception as e:
+            print(f"标签位图索引保存失败: {e}")
+
     # ── UI 构建 ──
     def init_ui(self):
         toolbar = ttk.Frame(self)
@@ -405,12 +430,22 @@ class App(tk.Tk):
         self.process_btn = ttk.Button(left_toolbar, text="开始批量处理", command=self.start_processing)
         self.process_btn.pack(side=tk.LEFT, padx=5)
 
+        self.watch_btn = ttk.Button(left_toolbar, text="监视文件夹", command=self.toggle_watch)
+        self.watch_btn.pack(side=tk.LEFT, padx=5)
+
         ttk.Button(left_toolbar, text="显示图库",
                    command=self.show_gallery).pack(side=tk.LEFT, padx=5)
 
+        self.browse_btn = ttk.Button(left_toolbar, command=self.toggle_browse_mode)
+        self.browse_btn.pack(side=tk.LEFT, padx=5)
+        self._update_browse_button()
+
         ttk.Button(left_toolbar, text="检查数据完整性",
                    command=self.check_data_integrity).pack(side=tk.LEFT, padx=5)
 
+        ttk.Button(left_toolbar, text="缓存统计",
+                   command=self.show_cache_stats).pack(side=tk.LEFT, padx=5)
+
         self.progress = ttk.Progressbar(toolbar, mode='determinate')
         self.progress.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=10)
 
@@ -432,13 +467,26 @@ class App(tk.Tk):
         self.center_panel.bind("<Configure>", self.on_center_panel_resize)
 
     def on_center_panel_resize(self, event):
+        """列数变化时延迟重排现有按钮（拖动窗口边框期间只执行最后一次）
+
+        分页模式不查询数据库；滚动模式下高度变化也会改变可见行数，同样延迟重排。
+        """
         if event.width > 0:
             thumb_width = THUMB_SIZE[0] + THUMB_PADDING
             new_columns = max(1, event.width // thumb_width)
-            if new_columns != self.columns_per_row:
+            if new_columns != self.columns_per_row or self.browse_mode == "scroll":
                 self.columns_per_row = new_columns
-                if hasattr(self, 'grid_frame'):
-                    self.load_images()
+                if self._resize_job is not None:
+                    self.after_cancel(self._resize_job)
+                self._resize_job = self.after(RESIZE_DEBOUNCE, self._relayout)
+
+    def _relayout(self):
+        self._resize_job = None
+        if self.browse_mode == "scroll":
+            self._update_scroll_region()
+            self._render_viewport()
+        else:
+            self._layout_grid()
 
     def build_left_panel(self, parent):
         search_frame = ttk.Frame(parent)
@@ -448,6 +496,7 @@ class App(tk.Tk):
         search_entry = ttk.Entry(search_frame, textvariable=self.search_var, width=SEARCH_ENTRY_W)
         search_entry.pack(side=tk.LEFT, padx=5)
         search_entry.bind("<Return>", lambda e: self.search_tags())
+        self.search_var.trace_add("write", self._on_search_typed)
 
         ttk.Button(search_frame, text="搜索", command=self.search_tags).pack(side=tk.LEFT)
 
@@ -476,21 +525,32 @@ class App(tk.Tk):
         container.pack(fill=tk.BOTH, expand=True)
 
         self.canvas = tk.Canvas(container, bg=MAIN_COLOR, highlightthickness=0)
-        scrollbar = ttk.Scrollbar(container, orient="vertical", command=self.canvas.yview)
-        self.canvas.configure(yscrollcommand=scrollbar.set)
+        self.center_scrollbar = ttk.Scrollbar(container, orient="vertical", command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=self._on_canvas_yview)
 
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.center_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
+        # 分页模式: 整页按钮放在 grid_frame 中；滚动模式下隐藏它，按钮直接作为画布窗口项摆放
         self.grid_frame = ttk.Frame(self.canvas)
-        self.canvas.create_window((0, 0), window=self.grid_frame, anchor="nw")
+        self._grid_window = self.canvas.create_window((0, 0), window=self.grid_frame, anchor="nw")
 
         self.pagination_frame = ttk.Frame(parent, height=PAGINATION_H)
         self.pagination_frame.pack(fill=tk.X, pady=5)
 
-        self.grid_frame.bind("<Configure>", lambda e: self.canvas.configure(scrollregion=self.canvas.bbox("all")))
+        self.grid_frame.bind("<Configure>", self._on_grid_frame_configure)
         self.canvas.bind_all("<MouseWheel>", lambda e: self.canvas.yview_scroll(-1 * (e.delta // 120), "units"))
 
+    def _on_grid_frame_configure(self, event):
+        if self.browse_mode == "pages":
+            self.canvas.configure(scrollregion=self.canvas.bbox(self._grid_window))
+
+    def _on_canvas_yview(self, first, last):
+        """画布视图变化（滚轮、拖动滚动条、改变大小）时更新滚动条；滚动模式下合并到空闲时重绘视口"""
+        self.center_scrollbar.set(first, last)
+        if self.browse_mode == "scroll" and self._scroll_job is None:
+            self._scroll_job = self.after_idle(self._render_viewport)
+
     def build_right_panel(self, parent):
         info_frame = ttk.LabelFrame(parent, text="图片信息", width=INFO_FRAME_W)
         info_frame.pack(fill=tk.X, padx=10, pady=5)
@@ -576,23 +636,23 @@ class App(tk.Tk):
 
     # ── 数据库 ──
     def init_database(self):
-        conn = sqlite3.connect(DB_FILE)
+        """建表 / 迁移旧版结构（见 prepare_database()），载入标签搜索索引与位图索引"""
+        conn = self.db.reader
         cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS tags
-                          (
-                              image_name TEXT,
-                              tag        TEXT,
-                              confidence REAL,
-                              UNIQUE (image_name, tag)
-                          )''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS image_metadata
-                          (
-                              image_name   TEXT PRIMARY KEY,
-                              file_size    INTEGER,
-                              process_time TEXT
-                          )''')
+        prepare_database(cursor)
+        if self.engine is not None:
+            self.engine.prepare(cursor)
+
+        self._load_tag_index(cursor)
+        if self.tag_bitmaps is not None:
+            self.tag_bitmaps.load(cursor)
+
         conn.commit()
-        conn.close()
+
+    def _load_tag_index(self, cursor):
+        # tag_vocab 已包含 selected_tags.csv 中的全部标签及用过的自定义标签
+        names = [name for name, _ in cursor.execute(SQL['vocab_ids'])] + [self.FAVORITE_TAG]
+        self.tag_index.load(names, dict(cursor.execute(SQL['tag_counts'])))
 
     # ── 标签搜索 ──
     def search_tags(self):
@@ -601,14 +661,32 @@ class App(tk.Tk):
             messagebox.showwarning("提示", "请输入搜索关键词")
             return
 
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT tag, COUNT(*) as count
-                          FROM tags
-                          WHERE tag LIKE ?
-                          GROUP BY tag
-                          ORDER BY count DESC''', (f'%{keyword}%',))
+        if TagQuery.is_query(keyword):
+            try:
+                self.show_query(TagQuery.parse(keyword))
+            except ValueError as e:
+                messagebox.showwarning("查询语法错误", str(e))
+            return
+
+        self._show_tag_results(keyword)
+
+        if keyword == self.FAVORITE_TAG.lower():
+            self.show_tag(self.FAVORITE_TAG)
+
+    def _on_search_typed(self, *args):
+        """边输入边搜索: 停止输入 SEARCH_DEBOUNCE 毫秒后刷新结果列表"""
+        if self._search_job is not None:
+            self.after_cancel(self._search_job)
+        self._search_job = self.after(SEARCH_DEBOUNCE, self._refresh_tag_results)
+
+    def _refresh_tag_results(self):
+        """按搜索框当前内容刷新标签列表（计数变化后也调用）"""
+        self._search_job = None
+        # 输入多标签查询时补全正在输入的那个标签
+        self._show_tag_results(TagQuery.completion_prefix(self.search_var.get()))
 
+    def _show_tag_results(self, keyword):
+        """从 TagIndex 查询并列出标签按钮，最多 SEARCH_LIMIT 个；其后列出当前结果中的常见标签"""
         self.tag_canvas.delete("all")
         # #1 修复: 使用 itemcget 正确获取 window 对象
         for w in self.get_canvas_windows():
@@ -616,16 +694,38 @@ class App(tk.Tk):
                 w.destroy()
 
         ypos = 10
-        for tag, count in cursor.fetchall():
-            btn = ttk.Button(self.tag_canvas, text=f"{tag} ({count})", command=lambda t=tag: self.show_tag(t))
-            self.tag_canvas.create_window((10, ypos), window=btn, anchor="nw", width=TAG_BUTTON_W)
-            ypos += 35
+        if keyword:
+            for tag, count in self.tag_index.search(keyword, limit=SEARCH_LIMIT):
+                btn = ttk.Button(self.tag_canvas, text=f"{tag} ({count})", command=lambda t=tag: self.show_tag(t))
+                self.tag_canvas.create_window((10, ypos), window=btn, anchor="nw", width=TAG_BUTTON_W)
+                ypos += 35
+
+        facets = self._current_facets()
+        if facets:
+            self.tag_canvas.create_text((10, ypos + 5), text="当前结果中的常见标签（点击缩小范围）:", anchor="nw")
+            ypos += 30
+            for tag, count in facets:
+                btn = ttk.Button(self.tag_canvas, text=f"+ {tag} ({count})",
+                                 command=lambda t=tag: self._refine_query(t))
+                self.tag_canvas.create_window((10, ypos), window=btn, anchor="nw", width=TAG_BUTTON_W)
+                ypos += 35
 
         self.tag_canvas.configure(scrollregion=self.tag_canvas.bbox("all"))
-        conn.close()
 
-        if keyword == self.FAVORITE_TAG.lower():
-            self.show_tag(self.FAVORITE_TAG)
+    def _current_facets(self):
+        """标签 / 查询视图中结果最常带的其他标签 [(标签名, 图片数)]，由标签位图索引统计"""
+        if self.tag_bitmaps is None or self.view_mode not in ("tag", "query"):
+            return []
+        key = (self.view_mode, self.current_tag)
+        if key not in self._facet_cache:
+            query = self.current_query or TagQuery.for_tag(self.current_tag)
+            self._facet_cache[key] = query.facets(self.db.reader.cursor(), self.tag_bitmaps) or []
+        return self._facet_cache[key]
+
+    def _refine_query(self, tag):
+        """在当前标签 / 查询上追加一个标签（AND）"""
+        self.search_var.set(f"{self.current_query or self.current_tag} {tag}")
+        self.search_tags()
 
     # #1 修复: 正确获取 Canvas 上的 window 组件
     def get_canvas_windows(self):
@@ -640,12 +740,9 @@ class App(tk.Tk):
     # ── 图片信息 / 原图预览 ──
     def show_image_info(self, image_name):
         self.selected_image = image_name
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+        cursor = self.db.reader.cursor()
 
-        cursor.execute('''SELECT file_size, process_time
-                          FROM image_metadata
-                          WHERE image_name = ?''', (image_name,))
+        cursor.execute(SQL['image_info'], (image_name,))
         result = cursor.fetchone()
         if result:
             file_size, process_time = result
@@ -656,10 +753,7 @@ class App(tk.Tk):
         self.info_labels['size'].config(text=f"{round(file_size / 1024)} KB")
         self.info_labels['time'].config(text=process_time[:19] if process_time != "未知" else "未知")
 
-        cursor.execute('''SELECT tag, confidence
-                          FROM tags
-                          WHERE image_name = ?
-                          ORDER BY confidence DESC''', (image_name,))
+        cursor.execute(SQL['image_tags'], (image_name,))
         all_tags = cursor.fetchall()
 
         main_tags = [(tag, conf) for tag, conf in all_tags if conf > MAIN_TAG_THRESHOLD]
@@ -690,8 +784,6 @@ class App(tk.Tk):
         self.tag_tree.tag_configure('detail', foreground='gray', font=('微软雅黑', 8))
         self.tag_tree.tag_configure('separator', foreground='lightgray', font=('微软雅黑', 7))
 
-        conn.close()
-
     def _on_detail_close(self, image_name):
         """原图窗口关闭回调 (#9 修复)"""
         if image_name in self.detail_windows:
@@ -717,16 +809,16 @@ class App(tk.Tk):
 
         img_path = os.path.join(ARCHIVE_FOLDER, image_name)
         try:
-            img = Image.open(img_path)
-            self.current_image = img.copy()
-
-            width, height = img.size
             screen_width = self.winfo_screenwidth()
             screen_height = self.winfo_screenheight()
             max_size = (int(screen_width * DETAIL_WIN_RATIO), int(screen_height * DETAIL_WIN_RATIO))
 
+            img = open_image(img_path, max_size)
+            self.current_image = img.copy()
+
+            width, height = img.size
             if width > max_size[0] or height > max_size[1]:
-                img.thumbnail(max_size)
+                img.thumbnail(max_size, reducing_gap=REDUCING_GAP)
 
             photo = ImageTk.PhotoImage(img)
             label = tk.Label(detail_win, image=photo)
@@ -740,42 +832,44 @@ class App(tk.Tk):
 
     # ── 收藏 ──
     def check_favorite_status(self, image_name):
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT 1
-                          FROM tags
-                          WHERE image_name = ?
-                            AND tag = ?''',
-                       (image_name, self.FAVORITE_TAG))
-        result = cursor.fetchone()
-        conn.close()
-        return result is not None
+        cursor = self.db.reader.cursor()
+        cursor.execute(SQL['has_tag'], (image_name, self.FAVORITE_TAG))
+        return cursor.fetchone() is not None
 
     def toggle_favorite(self, image_name, current_status):
+        conn = self.db.reader
         try:
-            conn = sqlite3.connect(DB_FILE)
             cursor = conn.cursor()
 
             if current_status:
-                cursor.execute('''DELETE
-                                  FROM tags
-                                  WHERE image_name = ?
-                                    AND tag = ?''',
-                               (image_name, self.FAVORITE_TAG))
+                cursor.execute(SQL['remove_tag'], (image_name, self.FAVORITE_TAG))
+                delta = -cursor.rowcount
             else:
-                cursor.execute('''INSERT OR REPLACE INTO tags
-                                  VALUES (?, ?, ?)''',
-                               (image_name, self.FAVORITE_TAG, 1.0))
+                # 自定义标签（收藏）不在模型标签表中，首次使用时加入 tag_vocab
+                cursor.execute(SQL['add_vocab'], (self.FAVORITE_TAG,))
+                cursor.execute(SQL['add_tag'], (1.0, image_name, self.FAVORITE_TAG))
+                delta = 1
 
             conn.commit()
+            self._invalidate_page_cache()
+            self.tag_index.adjust({self.FAVORITE_TAG: delta})
+            if self.tag_bitmaps is not None:
+                image_id, = cursor.execute(SQL['image_id'], (image_name,)).fetchone()
+                tag_id, _ = cursor.execute(SQL['query_tag_stats'], (self.FAVORITE_TAG,)).fetchone()
+                if current_status:
+                    self.tag_bitmaps.remove(image_id, [tag_id])
+                else:
+                    self.tag_bitmaps.add(image_id, [(tag_id, 1.0)])
+            self._refresh_tag_results()
 
             if self.current_tag == self.FAVORITE_TAG:
                 self.load_images()
 
         except Exception as e:
+            # 连接长期复用，未提交的改动不能留到下一次操作
+            if conn.in_transaction:
+                conn.rollback()
             messagebox.showerror("操作失败", str(e))
-        finally:
-            conn.close()
 
     # ── 右键菜单 ──
     def show_image_context_menu(self, event, img_path):
@@ -800,6 +894,8 @@ class App(tk.Tk):
             label="取消收藏" if is_favorited else "收藏图片",
             command=lambda: self.toggle_favorite(image_name, is_favorited)
         )
+        if self.embed_store is not None:
+            menu.add_command(label="查找相似图片", command=lambda: self.find_similar(image_name))
         menu.add_separator()
         menu.add_command(label="删除图片", command=lambda: self.delete_image(img_path))
         menu.post(event.x_root, event.y_root)
@@ -838,21 +934,34 @@ class App(tk.Tk):
         if not messagebox.askyesno("确认删除", "确定要永久删除这张图片吗？"):
             return
 
+        conn = self.db.reader
         try:
             image_name = os.path.basename(img_path)
 
-            conn = sqlite3.connect(DB_FILE)
             cursor = conn.cursor()
-            cursor.execute("DELETE FROM tags WHERE image_name = ?", (image_name,))
-            cursor.execute("DELETE FROM image_metadata WHERE image_name = ?", (image_name,))
+            removed = {tag: -1 for tag, _ in cursor.execute(SQL['image_tags'], (image_name,)).fetchall()}
+            row = cursor.execute(SQL['image_id'], (image_name,)).fetchone()
+            cursor.execute(SQL['delete_image_tags'], (image_name,))
+            cursor.execute(SQL['delete_image_probs'], (image_name,))
+            embedding = cursor.execute(SQL['embedding_row'], (image_name,)).fetchone()
+            cursor.execute(SQL['delete_image_embedding'], (image_name,))
+            cursor.execute(SQL['delete_image'], (image_name,))
             conn.commit()
-            conn.close()
+            self._invalidate_page_cache()
+            self.tag_index.adjust(removed)
+            if row and self.tag_bitmaps is not None:
+                self.tag_bitmaps.remove(row[0])
+            if embedding and self.similarity_index is not None:
+                self.similarity_index.remove(embedding[0])
+            if image_name in self.current_similar:
+                self.current_similar.remove(image_name)
+            self._refresh_tag_results()
 
             if os.path.exists(img_path):
                 os.remove(img_path)
 
-            if image_name in self.thumbnail_cache:
-                del self.thumbnail_cache[image_name]
+            self.thumbnail_cache.discard(image_name)
+            self.thumb_store.delete(image_name)
 
             self.load_images()
             messagebox.showinfo("删除成功", "图片已成功删除")
@@ -863,118 +972,407 @@ class App(tk.Tk):
                     del self.detail_windows[name]
 
         except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
             messagebox.showerror("删除失败", f"删除过程中发生错误：{str(e)}")
 
     # ── 视图模式 ──
     def show_tag(self, tag):
         self.view_mode = "tag"
         self.current_tag = tag
+        self.current_query = None
         self.current_page = 1
         self.update_sort_buttons_state()
         self.load_images()
+        self._refresh_tag_results()
 
     def show_gallery(self):
         self.view_mode = "gallery"
         self.current_tag = None
+        self.current_query = None
         self.current_page = 1
         self.update_sort_buttons_state()
         self.load_images()
+        self._refresh_tag_results()
 
-    # ── 图片加载与缓存 ──
-    # 排序字段映射（类常量，避免每次方法调用重复创建）
-    _GALLERY_SORT = {
-        'name': 'image_name',
-        'size': 'file_size',
-        'time': 'process_time',
-    }
-    _TAG_SORT = {
-        'name': 'm.image_name',
-        'size': 'm.file_size',
-        'time': 'm.process_time',
-        'confidence': 't.confidence',
-    }
+    def show_query(self, query):
+        """显示多标签查询（TagQuery）的结果，分页与排序同标签视图"""
+        self.view_mode = "query"
+        self.current_query = query
+        self.current_tag = str(query)
+        self.current_page = 1
+        self.update_sort_buttons_state()
+        self.load_images()
+        self._refresh_tag_results()
 
-    def load_images(self):
-        for widget in self.grid_frame.winfo_children():
-            widget.destroy()
+    def find_similar(self, image_name):
+        """以图搜图: 按嵌入向量的余弦相似度列出最相似的 SIMILAR_TOP_K 张图片
 
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+        首次查找时载入向量矩阵、为未保存向量的图片现算嵌入，以及搜索本身都在后台线程进行，
+        完成后回到主线程切换到相似图片视图。
+        """
+        try:
+            cursor = self.db.reader.cursor()
+            row = cursor.execute(SQL['embedding_row'], (image_name,)).fetchone()
+            if row is None and self.tagger is None:
+                messagebox.showinfo("查找相似图片", "这张图片没有保存嵌入向量，且模型未加载，无法计算")
+                return
+            entries = None
+            if self.similarity_index is None:
+                entries = cursor.execute(SQL['embedding_rows']).fetchall()
+        except Exception as e:
+            messagebox.showerror("查找相似图片", str(e))
+            return
+
+        # 只采用最近一次查找的结果
+        self._similar_request = image_name
+        self.config(cursor="watch")
+        future = self._thumb_executor.submit(self._search_similar, image_name, row[1] if row else None, entries)
+        future.add_done_callback(lambda f: self._on_similar_found(f, image_name))
+
+    def _search_similar(self, image_name, embed_row, entries):
+        """后台线程: 取查询向量、按需载入相似图片索引并搜索，返回 (索引, [(image_id, 相似度)])"""
+        vector = self._image_embedding(image_name, embed_row)
+        index = self.similarity_index
+        if index is None:
+            index = SimilarityIndex()
+            index.load(self.embed_store, entries)
+        return index, index.search(vector, SIMILAR_TOP_K + 1)
+
+    def _image_embedding(self, image_name, embed_row):
+        """取图片的嵌入向量：优先读向量库，没有时（开启保存之前处理的图片）用模型现算"""
+        if embed_row is not None:
+            return self.embed_store.read([embed_row])[0]
+        with open_image(os.path.join(ARCHIVE_FOLDER, image_name), IMAGE_SIZE) as img:
+            tensor = self.tagger.to_tensor(img.convert('RGB'))
+        return self.tagger.infer([tensor], embeddings=True)[1][0]
+
+    def _on_similar_found(self, future, image_name):
+        """后台线程回调: 通知主线程显示结果"""
+        try:
+            self.after(0, lambda: self._show_similar(future, image_name))
+        except (RuntimeError, tk.TclError):
+            pass    # 窗口已关闭
 
+    def _show_similar(self, future, image_name):
+        """主线程: 登记新载入的索引并切换到相似图片视图"""
+        if image_name != self._similar_request:
+            return
+        self._similar_request = None
+        self.config(cursor="")
         try:
-            if self.view_mode == "gallery":
-                count_query = "SELECT COUNT(*) FROM image_metadata"
-                data_query = f'''
-                    SELECT image_name
-                    FROM image_metadata
-                    ORDER BY {self._GALLERY_SORT[self.sort_by]} {self.sort_order}
-                    LIMIT ? OFFSET ?
-                '''
-                cursor.execute(count_query)
-                total = cursor.fetchone()[0]
+            index, results = future.result()
+            if self.similarity_index is None:
+                self.similarity_index = index
+                if self.engine is not None:
+                    self.engine.similarity_index = index
+
+            cursor = self.db.reader.cursor()
+            names = []
+            for image_id, _ in results:
+                row = cursor.execute(SQL['image_name_by_id'], (image_id,)).fetchone()
+                if row and row[0] != image_name:
+                    names.append(row[0])
+        except Exception as e:
+            messagebox.showerror("查找相似图片", str(e))
+            return
+
+        self.view_mode = "similar"
+        self.current_tag = f"与 {image_name} 相似"
+        self.current_query = None
+        self.current_similar = names[:SIMILAR_TOP_K]
+        self.current_page = 1
+        self.update_sort_buttons_state()
+        self.load_images()
+        self._refresh_tag_results()
+
+    def toggle_browse_mode(self):
+        """在分页浏览与滚动浏览之间切换"""
+        self.browse_mode = "scroll" if self.browse_mode == "pages" else "pages"
+        self._update_browse_button()
+        if self.view_mode == "gallery" or self.current_tag:
+            self.load_images()
+
+    def _update_browse_button(self):
+        self.browse_btn.config(text="分页浏览" if self.browse_mode == "scroll" else "滚动浏览")
+
+    # ── 图片加载与缓存 ──
+    def load_images(self):
+        """立即用占位图绘制当前页（滚动模式为当前视口），未缓存的缩略图交给后台线程解码"""
+        self._cancel_thumbnail_requests()
+
+        cursor = self.db.reader.cursor()
+
+        count_key = (self.view_mode, self.current_tag)
+        total = self._count_cache.get(count_key)
+        if self.view_mode == "similar":
+            total = len(self.current_similar)
+        elif total is None:
+            if self.view_mode == "query":
+                total = self.current_query.count(cursor, self.tag_bitmaps)
+            elif self.view_mode == "gallery":
+                total = cursor.execute(SQL['gallery_count']).fetchone()[0]
             else:
-                count_query = '''
-                    SELECT COUNT(DISTINCT m.image_name)
-                    FROM tags t
-                        JOIN image_metadata m ON t.image_name = m.image_name
-                    WHERE t.tag = ?
-                '''
-                cursor.execute(count_query, (self.current_tag,))
-                total = cursor.fetchone()[0]
-
-                data_query = f'''
-                    SELECT DISTINCT m.image_name
-                    FROM tags t
-                    JOIN image_metadata m ON t.image_name = m.image_name
-                    WHERE t.tag = ?
-                    ORDER BY {self._TAG_SORT[self.sort_by]} {self.sort_order}
-                    LIMIT ? OFFSET ?
-                '''
-
-            self.total_pages = (total + self.page_size - 1) // self.page_size
-            offset = (self.current_page - 1) * self.page_size
-
-            if self.view_mode == "gallery":
-                cursor.execute(data_query, (self.page_size, offset))
+                cursor.execute(SQL['tag_count'], (self.current_tag,))
+                total = (cursor.fetchone() or (0,))[0]
+            self._count_cache[count_key] = total
+
+        self.total_pages = (total + self.page_size - 1) // self.page_size
+        if self.browse_mode == "scroll":
+            self._show_scroll_view(total)
+            return
+
+        self._hide_scroll_view()
+        page_names = self._fetch_page(cursor)
+        self.thumbnail_cache.retain(page_names)
+
+        # 池中按钮不足时补足，多余的在 _layout_grid() 中隐藏
+        while len(self._thumb_pool) < len(page_names):
+            self._thumb_pool.append(ThumbnailButton(
+                self.grid_frame, self._get_placeholder_thumbnail(), "",
+                click_command=None, dblclick_command=None,
+                context_menu_command=self.show_thumbnail_context_menu))
+
+        for btn, image_name in zip(self._thumb_pool, page_names):
+            thumbnail = self._cached_thumbnail(image_name)
+            btn.bind_item(thumbnail or self._get_placeholder_thumbnail(), image_name,
+                          click_command=lambda n=image_name: self.show_image_info(n),
+                          dblclick_command=lambda n=image_name: self.show_original_image(n))
+            if thumbnail is None:
+                self._thumb_waiters[image_name] = btn
+                self._submit_thumbnail(image_name)
+
+        self._visible_thumbs = len(page_names)
+        self._empty_text = self._empty_message()
+        self._layout_grid()
+
+        self.update_pagination()
+        self.after_idle(self._prefetch_adjacent_pages, self._thumb_generation)
+
+    def _empty_message(self):
+        if self.view_mode == "gallery":
+            return "图库中没有图片"
+        if self.view_mode == "query":
+            return f"没有符合查询 '{self.current_tag}' 的图片"
+        if self.view_mode == "similar":
+            return "没有找到相似的图片"
+        return f"没有找到标签为 '{self.current_tag}' 的图片"
+
+    def _layout_grid(self):
+        """按当前列数摆放池中前 _visible_thumbs 个按钮，其余隐藏；无图片时显示提示"""
+        self._resize_job = None
+        for idx, btn in enumerate(self._thumb_pool):
+            if idx < self._visible_thumbs:
+                row, col = divmod(idx, self.columns_per_row)
+                btn.grid(row=row, column=col, padx=5, pady=5)
             else:
-                cursor.execute(data_query, (self.current_tag, self.page_size, offset))
-
-            row, col = 0, 0
-            valid_count = 0
-
-            for idx, (image_name,) in enumerate(cursor.fetchall()):
-                thumbnail = self.get_thumbnail(image_name)
-
-                if thumbnail:
-                    btn = ThumbnailButton(
-                        self.grid_frame,
-                        thumbnail,
-                        image_name,
-                        click_command=lambda n=image_name: self.show_image_info(n),
-                        dblclick_command=lambda n=image_name: self.show_original_image(n),
-                        context_menu_command=self.show_thumbnail_context_menu
-                    )
-                    btn.grid(row=row, column=col, padx=5, pady=5)
-
-                    col += 1
-                    valid_count += 1
-
-                    if col >= self.columns_per_row:
-                        col = 0
-                        row += 1
-
-            if valid_count == 0:
-                message_text = "图库中没有图片" if self.view_mode == "gallery" \
-                    else f"没有找到标签为 '{self.current_tag}' 的图片"
-                tk.Label(self.grid_frame,
-                         text=message_text,
-                         bg=MAIN_COLOR, font=('微软雅黑', 12)).grid(
-                    row=0, column=0, columnspan=self.columns_per_row, pady=50)
-
-            self.update_pagination()
+                btn.grid_remove()
+
+        if self._visible_thumbs == 0:
+            if self._empty_label is None:
+                self._empty_label = tk.Label(self.grid_frame, bg=MAIN_COLOR, font=('微软雅黑', 12))
+            self._empty_label.config(text=self._empty_text)
+            self._empty_label.grid(row=0, column=0, columnspan=self.columns_per_row, pady=50)
+        elif self._empty_label is not None:
+            self._empty_label.grid_remove()
+
+    # ── 滚动浏览 ──
+    def _show_scroll_view(self, total):
+        """切到滚动模式并重绘视口；视图/标签/排序不变时（如删除、收藏后刷新）保持滚动位置"""
+        self.canvas.itemconfigure(self._grid_window, state='hidden')
+        for widget in self.pagination_frame.winfo_children():
+            widget.destroy()
+        self._scroll_status = ttk.Label(self.pagination_frame)
+        self._scroll_status.pack()
+
+        key = (self.view_mode, self.current_tag, self.sort_by, self.sort_order)
+        self._scroll_blocks.clear()
+        self._scroll_total = total
+        # 换图片时按钮必须重新绑定，即使图片名相同（缩略图可能已变）
+        for btn, _ in self._scroll_pool:
+            btn.image_name = None
+
+        self._update_scroll_region()
+        if key != self._scroll_key:
+            self._scroll_key = key
+            self.canvas.yview_moveto(0)
+        self._render_viewport()
+
+    def _hide_scroll_view(self):
+        """回到分页模式: 隐藏滚动模式的画布窗口项，恢复 grid_frame"""
+        for _, item in self._scroll_pool:
+            self.canvas.itemconfigure(item, state='hidden')
+        if self._scroll_empty is not None:
+            self.canvas.itemconfigure(self._scroll_empty, state='hidden')
+        self._scroll_blocks.clear()
+        self._scroll_key = None
+        self.canvas.itemconfigure(self._grid_window, state='normal')
+        self.canvas.yview_moveto(0)
+
+    def _scroll_cell(self):
+        """单元格宽高（像素），行高由第一个按钮的实际高度测得"""
+        if self._scroll_row_h is None:
+            btn, _ = self._new_scroll_slot()
+            btn.update_idletasks()
+            self._scroll_row_h = btn.winfo_reqheight() + 10
+        return THUMB_SIZE[0] + THUMB_PADDING, self._scroll_row_h
+
+    def _new_scroll_slot(self):
+        btn = ThumbnailButton(self.canvas, self._get_placeholder_thumbnail(), "",
+                              click_command=None, dblclick_command=None,
+                              context_menu_command=self.show_thumbnail_context_menu)
+        btn.image_name = None
+        item = self.canvas.create_window(0, 0, window=btn, anchor="nw", state='hidden')
+        self._scroll_pool.append((btn, item))
+        return btn, item
+
+    def _update_scroll_region(self):
+        """滚动区域按总行数计算，与实际创建的控件数量无关"""
+        cell_w, row_h = self._scroll_cell()
+        rows = (self._scroll_total + self.columns_per_row - 1) // self.columns_per_row
+        self.canvas.configure(scrollregion=(0, 0, cell_w * self.columns_per_row, rows * row_h))
+
+    def _scroll_names(self, start, end):
+        """取排序后第 start..end-1 张图片名：按页读取并缓存，相邻页由键集边界接续"""
+        first_page = start // self.page_size + 1
+        last_page = (end - 1) // self.page_size + 1
+        pages = range(first_page, last_page + 1)
+
+        missing = [p for p in pages if p not in self._scroll_blocks]
+        if missing:
+            cursor = self.db.reader.cursor()
+            for page in missing:
+                self._scroll_blocks[page] = self._fetch_page(cursor, page)
+
+        names = []
+        for page in pages:
+            self._scroll_blocks.move_to_end(page)
+            names += self._scroll_blocks[page]
+        # 只保留视口附近的页: 来回小幅滚动不必重新查询，内存也不随图库大小增长
+        while len(self._scroll_blocks) > 2 * len(pages) + 2:
+            self._scroll_blocks.popitem(last=False)
+
+        offset = start - (first_page - 1) * self.page_size
+        return names[offset:offset + end - start]
+
+    def _render_viewport(self):
+        """把可见行（含上下预留行）的图片绑定到控件池并摆放到对应位置，其余控件隐藏"""
+        self._scroll_job = None
+        if self.browse_mode != "scroll" or self._scroll_key is None:
+            return
 
-        finally:
-            conn.close()
+        cell_w, row_h = self._scroll_cell()
+        columns = self.columns_per_row
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        total_rows = (self._scroll_total + columns - 1) // columns
+
+        first_row = max(0, int(top // row_h) - SCROLL_OVERSCAN)
+        last_row = min(total_rows, int(bottom // row_h) + 1 + SCROLL_OVERSCAN)
+        start = first_row * columns
+        end = min(self._scroll_total, last_row * columns)
+        names = self._scroll_names(start, end) if end > start else []
+
+        while len(self._scroll_pool) < len(names):
+            self._new_scroll_slot()
+
+        # 控件按图片序号取模分配: 滚动时仍在视口内的图片保持原控件，无需重新绑定
+        used = {}
+        waiters = {}
+        for index, image_name in enumerate(names, start):
+            slot = index % len(self._scroll_pool)
+            btn, item = self._scroll_pool[slot]
+            used[slot] = True
+            row, col = divmod(index, columns)
+            self.canvas.coords(item, col * cell_w + 5, row * row_h + 5)
+            self.canvas.itemconfigure(item, state='normal')
+
+            if btn.image_name != image_name:
+                thumbnail = self._cached_thumbnail(image_name)
+                btn.bind_item(thumbnail or self._get_placeholder_thumbnail(), image_name,
+                              click_command=lambda n=image_name: self.show_image_info(n),
+                              dblclick_command=lambda n=image_name: self.show_original_image(n))
+                if thumbnail is None:
+                    waiters[image_name] = btn
+                    self._submit_thumbnail(image_name)
+            elif image_name in self._thumb_waiters:
+                waiters[image_name] = btn
+
+        for slot, (btn, item) in enumerate(self._scroll_pool):
+            if slot not in used:
+                self.canvas.itemconfigure(item, state='hidden')
+
+        # 已滚出视口、尚未开始解码的缩略图请求直接取消；控件下次进入视口时重新绑定
+        for image_name in self._thumb_waiters.keys() - waiters.keys():
+            btn = self._thumb_waiters[image_name]
+            if btn.image_name == image_name:
+                btn.image_name = None
+            future = self._pending_thumbs.get(image_name)
+            if future is not None and future.cancel():
+                del self._pending_thumbs[image_name]
+        self._thumb_waiters = waiters
+        self.thumbnail_cache.retain(names)
+
+        self._update_scroll_status(top, bottom, row_h, columns)
+
+    def _update_scroll_status(self, top, bottom, row_h, columns):
+        """分页栏位置显示当前可见范围；无图片时在画布上显示提示"""
+        if self._scroll_total == 0:
+            message_text = self._empty_message()
+            if self._scroll_empty is None:
+                self._scroll_empty = self.canvas.create_text(0, 50, anchor="n", font=('微软雅黑', 12))
+            self.canvas.coords(self._scroll_empty, self.canvas.winfo_width() // 2, 50)
+            self.canvas.itemconfigure(self._scroll_empty, text=message_text, state='normal')
+            self._scroll_status.config(text="")
+            return
+
+        if self._scroll_empty is not None:
+            self.canvas.itemconfigure(self._scroll_empty, state='hidden')
+        first = int(top // row_h) * columns + 1
+        last = min(self._scroll_total, (int(bottom // row_h) + 1) * columns)
+        self._scroll_status.config(text=f"第 {first}-{last} 张 / 共 {self._scroll_total} 张")
+
+    def _fetch_page(self, cursor, page=None):
+        """取第 page 页（默认当前页）的图片名
+
+        键集模式下从最近一个已知的页边界（之前访问过的页的最后一行）向后 seek，
+        只需跳过两页之间的行；跳到从未到过的远端页时退化为从头 OFFSET。
+        相似图片视图的结果已在内存中，直接切片。
+        """
+        if self.view_mode == "similar":
+            start = ((page or self.current_page) - 1) * self.page_size
+            return self.current_similar[start:start + self.page_size]
+
+        anchors = self._page_anchors.setdefault(
+            (self.view_mode, self.current_tag, self.sort_by, self.sort_order), {})
+
+        page = page or self.current_page
+        start_page, anchor = 1, ()
+        if PAGINATION_MODE == "keyset":
+            known = [p for p in anchors if p < page]
+            if known:
+                start_page = max(known) + 1
+                anchor = anchors[start_page - 1]
+
+        offset = (page - start_page) * self.page_size
+        if self.view_mode == "query":
+            rows = self.current_query.page(cursor, self.sort_by, self.sort_order,
+                                           self.page_size, offset, anchor)
+        else:
+            params = () if self.view_mode == "gallery" else (self.current_tag,)
+            cursor.execute(page_query(self.view_mode, self.sort_by, self.sort_order, seek=bool(anchor)),
+                           params + anchor + (self.page_size, offset))
+            rows = cursor.fetchall()
+
+        if rows and PAGINATION_MODE == "keyset":
+            anchors[page] = page_anchor(rows[-1])
+        return [name for name, _ in rows]
+
+    def _invalidate_page_cache(self):
+        """写库后清空分页总数与页边界缓存"""
+        self._count_cache.clear()
+        self._page_anchors.clear()
+        self._facet_cache.clear()
 
     def update_pagination(self):
         for widget in self.pagination_frame.winfo_children():
@@ -989,43 +1387,153 @@ class App(tk.Tk):
         self.current_page = page
         self.load_images()
 
-    # #5 + #8 修复: LRU 限制 + 合并验证打开
-    def get_thumbnail(self, image_name):
-        """获取缩略图（LRU 缓存 + 单次打开验证）"""
-        # LRU: 如果已在缓存中，移到末尾（最近使用）
-        if image_name in self.thumbnail_cache:
-            self.thumbnail_cache.move_to_end(image_name)
-            return self.thumbnail_cache[image_name]
+    def _cached_thumbnail(self, image_name):
+        """内存缓存查询，命中时返回 PhotoImage"""
+        return self.thumbnail_cache.photo(image_name)
 
+    def _decode_thumbnail(self, image_name):
+        """加载缩略图像素写入内存缓存（失败时写入错误占位图），可在后台线程调用"""
+        img = self._load_thumbnail_image(image_name)
+        self.thumbnail_cache.put(image_name, img if img is not None else self._get_error_image())
+
+    def _load_thumbnail_image(self, image_name):
+        """磁盘缓存 → 解码原图，返回 PIL 缩略图；失败返回 None。不触碰 Tk，可在后台线程调用"""
         image_path = os.path.join(ARCHIVE_FOLDER, image_name)
         try:
-            # 快速文件大小检查
-            if os.path.getsize(image_path) == 0:
-                raise ValueError("文件为空")
-
-            # #8 修复: 只打开一次图片，同时完成验证和缩略图生成
-            img = Image.open(image_path)
-            img.thumbnail(THUMB_SIZE)
-            thumbnail = ImageTk.PhotoImage(img)
+            img = self.thumb_store.get(image_name, image_path)
+            if img is not None:
+                self._count_stat('store_hits')
+            else:
+                self._count_stat('decodes')
+                # 快速文件大小检查
+                if os.path.getsize(image_path) == 0:
+                    raise ValueError("文件为空")
+
+                # #8 修复: 只打开一次图片，同时完成验证和缩略图生成
+                img = open_image(image_path, THUMB_SIZE)
+                img.thumbnail(THUMB_SIZE, reducing_gap=REDUCING_GAP)
+                try:
+                    self.thumb_store.put(image_name, image_path, img)
+                except Exception as e:
+                    print(f"缩略图缓存写入失败: {image_name} - {str(e)}")
+            return img
 
         except Exception as e:
             print(f"缩略图生成错误: {image_name} - {str(e)}")
-            thumbnail = self._get_error_thumbnail()
-
-        # 缓存
-        self.thumbnail_cache[image_name] = thumbnail
-
-        # #5 修复: LRU 逐出最旧条目
-        while len(self.thumbnail_cache) > THUMB_CACHE_MAX:
-            self.thumbnail_cache.popitem(last=False)
-
-        return thumbnail
-
-    def _get_error_thumbnail(self):
+            self._count_stat('errors')
+            return None
+
+    def _submit_thumbnail(self, image_name):
+        """提交后台解码任务；同名任务已在进行中则复用"""
+        future = self._pending_thumbs.get(image_name)
+        if future is None or future.cancelled():
+            future = self._thumb_executor.submit(self._decode_thumbnail, image_name)
+            self._pending_thumbs[image_name] = future
+            future.add_done_callback(lambda f: self._on_thumbnail_loaded(f, image_name))
+
+    def _on_thumbnail_loaded(self, future, image_name):
+        """后台线程回调: 像素已写入缓存，通知主线程"""
+        if future.cancelled():
+            return
+        try:
+            self.after(0, lambda: self._apply_thumbnail(image_name))
+        except (RuntimeError, tk.TclError):
+            pass    # 窗口已关闭
+
+    def _apply_thumbnail(self, image_name):
+        """主线程: 若当前页有按钮在等待则生成 PhotoImage 替换占位图；预取结果只留在 raw 层"""
+        self._pending_thumbs.pop(image_name, None)
+
+        button = self._thumb_waiters.pop(image_name, None)
+        if button is not None:
+            thumbnail = self.thumbnail_cache.photo(image_name, count=False)
+            if thumbnail is not None and button.winfo_exists():
+                button.set_image(thumbnail)
+        elif image_name in self._prefetch_names:
+            self.thumbnail_cache.mark_prefetched(image_name)
+
+    def _cancel_thumbnail_requests(self):
+        """作废当前页尚未开始的缩略图请求（换页、换标签、换排序时调用）"""
+        self._thumb_generation += 1
+        for image_name in self._thumb_waiters:
+            future = self._pending_thumbs.get(image_name)
+            if future is not None and future.cancel():
+                del self._pending_thumbs[image_name]
+        self._thumb_waiters = {}
+
+    def _prefetch_adjacent_pages(self, generation):
+        """空闲时预取前后 PREFETCH_PAGES 页的缩略图，总量受 PREFETCH_BUDGET 限制"""
+        if generation != self._thumb_generation:
+            return      # 调度后页面已切换，由新页面重新调度
+
+        pages = []
+        for distance in range(1, PREFETCH_PAGES + 1):
+            pages += [p for p in (self.current_page + distance, self.current_page - distance)
+                      if 1 <= p <= self.total_pages]
+        # 不超过预取预算，也不挤掉缓存中当前页的缩略图
+        budget = min(PREFETCH_BUDGET, THUMB_CACHE_BYTES - self.page_size * THUMB_BYTES) // THUMB_BYTES
+
+        cursor = self.db.reader.cursor()
+        names = [name for page in pages for name in self._fetch_page(cursor, page)]
+        names = [name for name in names if name not in self.thumbnail_cache][:max(0, budget)]
+
+        # 上一轮预取中已不再相邻的页面，尚未开始的任务直接取消
+        for name in self._prefetch_names - set(names) - set(self._thumb_waiters):
+            future = self._pending_thumbs.get(name)
+            if future is not None and future.cancel():
+                del self._pending_thumbs[name]
+
+        self._prefetch_names = set(names)
+        for name in names:
+            self._submit_thumbnail(name)
+            self._count_stat('prefetch_requests')
+
+    def _count_stat(self, key):
+        with self._thumb_stats_lock:
+            self._thumb_stats[key] += 1
+
+    def thumbnail_cache_stats(self):
+        """缩略图缓存命中统计（内存缓存 / 磁盘缓存 / 预取）"""
+        with self._thumb_stats_lock:
+            stats = dict(self._thumb_stats)
+        stats.update({f"memory_{key}": value for key, value in self.thumbnail_cache.stats().items()})
+        lookups = stats.get('memory_hits', 0) + stats.get('memory_misses', 0)
+        stats['memory_hit_rate'] = stats.get('memory_hits', 0) / lookups if lookups else 0.0
+        return stats
+
+    def show_cache_stats(self):
+        stats = self.thumbnail_cache_stats()
+        report = "缩略图缓存统计:\n\n"
+        report += f"内存缓存: {stats['memory_entries']} 张，"
+        report += f"{stats['memory_bytes'] / 1048576:.1f}/{THUMB_CACHE_BYTES / 1048576:.1f} MB，"
+        report += f"显示中 {stats['memory_live']} 张\n"
+        report += f"命中率 {stats['memory_hit_rate'] * 100:.1f}%"
+        report += f"（命中 {stats.get('memory_hits', 0)} / 未命中 {stats.get('memory_misses', 0)}）\n"
+        report += f"LRU 逐出: {stats.get('memory_evictions', 0)} 张\n"
+        report += f"磁盘缓存命中: {stats.get('store_hits', 0)} 张\n"
+        report += f"解码原图: {stats.get('decodes', 0)} 张（失败 {stats.get('errors', 0)}）\n\n"
+        report += f"预取请求: {stats.get('prefetch_requests', 0)} 张\n"
+        report += f"预取后被访问: {stats.get('memory_prefetch_hits', 0)} 张\n"
+        report += f"预取后未访问即被逐出: {stats.get('memory_prefetch_wasted', 0)} 张\n"
+        if stats.get('memory_prefetch_wasted', 0):
+            report += "\n⚠ 有预取结果未被使用就被逐出，可考虑调大 thumbnail_cache_bytes"
+        top = self.query_timer.top()
+        if top:
+            report += "\n\n查询耗时（按总耗时）:\n"
+            for label, count, total, longest in top:
+                report += f"  • {label}: {count} 次，共 {total * 1000:.1f} ms，最长 {longest * 1000:.1f} ms\n"
+        messagebox.showinfo("缓存统计", report)
+
+    def _get_placeholder_thumbnail(self):
+        if self._placeholder_thumb is None:
+            self._placeholder_thumb = ImageTk.PhotoImage(Image.new('RGB', THUMB_SIZE, color=ACCENT_COLOR))
+        return self._placeholder_thumb
+
+    def _get_error_image(self):
         img = Image.new('RGB', THUMB_SIZE, color='red')
         draw = ImageDraw.Draw(img)
         draw.text((10, 10), "ERR", fill='white')
-        return ImageTk.PhotoImage(img)
+        return img
 
     # #3 修复: 移除嵌套 mainloop（此方法当前未被调用，保留作备用）
     def show_image_detail(self, image_name):
@@ -1033,17 +1541,13 @@ class App(tk.Tk):
         detail_win = tk.Toplevel(self)
         detail_win.title(image_name)
 
-        img = Image.open(os.path.join(ARCHIVE_FOLDER, image_name))
-        img.thumbnail(DETAIL_IMG_MAX)
+        img = open_image(os.path.join(ARCHIVE_FOLDER, image_name), DETAIL_IMG_MAX)
+        img.thumbnail(DETAIL_IMG_MAX, reducing_gap=REDUCING_GAP)
         photo = ImageTk.PhotoImage(img)
         tk.Label(detail_win, image=photo).pack()
 
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT tag, confidence
-                          FROM tags
-                          WHERE image_name = ?
-                          ORDER BY confidence DESC''', (image_name,))
+        cursor = self.db.reader.cursor()
+        cursor.execute(SQL['image_tags'], (image_name,))
 
         tree = ttk.Treeview(detail_win, columns=('tag', 'confidence'), show='headings')
         tree.heading('tag', text='标签')
@@ -1055,122 +1559,101 @@ class App(tk.Tk):
             tree.insert('', 'end', values=(tag, f"{conf * 100:.2f}%"))
 
         tree.pack(fill=tk.BOTH, expand=True)
-        conn.close()
         # 不调用 mainloop()，子窗口由主循环驱动
 
     # ── 批量处理 (#6, #10 修复) ──
-    def start_processing(self):
+    def _can_process(self):
         # #4 修复: 模型未加载时的检查
         if self.tagger is None:
             messagebox.showerror("错误",
                                  "标签模型未加载，无法处理图片。\n"
                                  "请检查 model.safetensors 文件是否存在。")
-            return
+            return False
 
         if not os.path.exists(INPUT_FOLDER):
             messagebox.showerror("错误", f"输入文件夹 {INPUT_FOLDER} 不存在")
-            return
+            return False
+        return True
 
+    def _start_worker(self, target):
         self.process_btn.config(state=tk.DISABLED)
         self.progress['value'] = 0
 
         # #10 修复: 非 daemon 线程 + 停止信号
         self._stop_event.clear()
-        self._worker_thread = threading.Thread(target=self.process_images, daemon=False)
+        self._worker_thread = threading.Thread(target=target, daemon=False)
         self._worker_thread.start()
 
-    def process_images(self):
-        """处理图片（使用新模型）"""
-        conn = None         # #6 修复: 循环外维持单一连接
-        try:
-            image_files = [f for f in os.listdir(INPUT_FOLDER) if f.lower().endswith(VALID_EXTENSIONS)]
-            total = len(image_files)
-
-            renamed_count = 0
-            overwritten_count = 0
+    def start_processing(self):
+        if not self._can_process():
+            return
+        self.watch_btn.config(state=tk.DISABLED)
+        self._start_worker(self.process_images)
 
-            # #6 修复: 整个循环共用一条数据库连接
-            conn = sqlite3.connect(DB_FILE)
+    def toggle_watch(self):
+        """开始 / 停止监视输入文件夹，新图片写完后自动入库"""
+        if self._watching:
+            # 当前批次处理完后监视线程退出，再恢复按钮
+            self._stop_event.set()
+            self.watch_btn.config(state=tk.DISABLED)
+            return
+        if not self._can_process():
+            return
+        self._watching = True
+        self.watch_btn.config(text="停止监视")
+        self._start_worker(self.watch_images)
 
-            for idx, filename in enumerate(image_files, 1):
-                # #10 修复: 检查停止信号
-                if self._stop_event.is_set():
-                    self.after(0, lambda: messagebox.showinfo("已取消",
-                                                               f"处理已中断，已完成 {idx - 1}/{total} 张"))
-                    return
+    def watch_images(self):
+        """监视线程: 由 IngestEngine.watch() 持续入库，直到停止信号"""
+        try:
+            self.engine.watch(INPUT_FOLDER, on_run=self._on_watch_run)
+        except Exception as e:
+            self.log_error(f"监视失败: {str(e)}")
+        finally:
+            self._watching = False
+            self.after(0, self._on_worker_finished)
 
-                src_path = os.path.join(INPUT_FOLDER, filename)
+    def _on_watch_run(self, stats):
+        """监视模式下每个微批次入库后: 汇报结果、刷新标签计数"""
+        for new_name, old_name, distance in stats['near_duplicates']:
+            print(f"近似重复: {new_name} ≈ {old_name}（相差 {distance} 位）")
+        self.update_progress(100, self.engine.summary(stats))
+        self.after(0, self._refresh_tag_results)
 
-                try:
-                    dest_path = os.path.join(ARCHIVE_FOLDER, filename)
-                    if os.path.exists(dest_path):
-                        unique_name = self._get_unique_filename(filename)
-                        dest_path = os.path.join(ARCHIVE_FOLDER, unique_name)
-                        final_filename = unique_name
-                        renamed_count += 1
-                        print(f"重名处理: {filename} -> {unique_name}")
-                    else:
-                        final_filename = filename
-
-                    # 使用新模型预测
-                    img = Image.open(src_path).convert('RGB')
-                    tag_confidences = self.tagger.predict(img, threshold=PROCESS_THRESHOLD)
-
-                    cursor = conn.cursor()
-
-                    cursor.execute("SELECT 1 FROM image_metadata WHERE image_name = ?", (final_filename,))
-                    if cursor.fetchone():
-                        cursor.execute("DELETE FROM image_metadata WHERE image_name = ?", (final_filename,))
-                        cursor.execute("DELETE FROM tags WHERE image_name = ?", (final_filename,))
-                        overwritten_count += 1
-
-                    cursor.execute('''INSERT INTO image_metadata
-                                      VALUES (?, ?, ?)''',
-                                   (final_filename, os.path.getsize(src_path),
-                                    datetime.now().isoformat()))
-                    cursor.executemany('''INSERT INTO tags
-                                          VALUES (?, ?, ?)''',
-                                       [(final_filename, tag, round(conf, 5))
-                                        for tag, conf in tag_confidences])
-                    conn.commit()
-
-                    shutil.move(src_path, dest_path)
-
-                    status_msg = f"处理中: {filename}"
-                    if final_filename != filename:
-                        status_msg += f" -> {final_filename}"
-
-                    self.update_progress(idx / total * 100, status_msg)
+    def _on_worker_finished(self):
+        self.process_btn.config(state=tk.NORMAL)
+        self.watch_btn.config(text="监视文件夹", state=tk.NORMAL)
 
-                except Exception as e:
-                    self.log_error(f"处理失败: {filename}\n{str(e)}")
+    def process_images(self):
+        """处理线程: 由 IngestEngine 完成入库，结束后在界面上汇报"""
+        try:
+            stats = self.engine.run(INPUT_FOLDER)
+            if stats['cancelled']:
+                self.after(0, lambda: messagebox.showinfo(
+                    "已取消", f"处理已中断，已完成 {stats['done']}/{stats['total']} 张"))
+                return
 
-            # 统计
-            stats_msg = f"处理完成! 共 {total} 张图片"
-            if renamed_count > 0:
-                stats_msg += f", {renamed_count} 张因重名被重命名"
-            if overwritten_count > 0:
-                stats_msg += f", {overwritten_count} 张覆盖了旧记录"
+            stats_msg = self.engine.summary(stats)
+            near_duplicates = stats['near_duplicates']
+            if near_duplicates:
+                for new_name, old_name, distance in near_duplicates:
+                    print(f"近似重复: {new_name} ≈ {old_name}（相差 {distance} 位）")
+                stats_msg += f"\n\n发现 {len(near_duplicates)} 组近似重复的图片:\n"
+                stats_msg += "\n".join(f"  • {new_name} ≈ {old_name}"
+                                       for new_name, old_name, _ in near_duplicates[:10])
+                if len(near_duplicates) > 10:
+                    stats_msg += "\n  • ... 完整列表见控制台输出"
 
             self.update_progress(100, "处理完成!")
             self.after(0, lambda: messagebox.showinfo("完成", stats_msg))
-            self.search_tags()
-
+            self.after(0, self._refresh_tag_results)
+        except Exception as e:
+            self.log_error(f"处理失败: {str(e)}")
         finally:
-            # #6 修复: 确保连接关闭
-            if conn:
-                conn.close()
-            self.after(0, lambda: self.process_btn.config(state=tk.NORMAL))
-
-    def _get_unique_filename(self, filename):
-        base_name, ext = os.path.splitext(filename)
-        counter = 1
-        while True:
-            new_filename = f"{base_name}_{counter}{ext}"
-            new_dest_path = os.path.join(ARCHIVE_FOLDER, new_filename)
-            if not os.path.exists(new_dest_path):
-                return new_filename
-            counter += 1
+            self.after(0, self._on_worker_finished)
+
+    def _on_engine_progress(self, done, total, message):
+        self.update_progress(done / total * 100 if total else 100, message)
 
     def update_progress(self, value, message):
         self.after(0, lambda: self.progress.config(value=value))
@@ -1182,16 +1665,16 @@ class App(tk.Tk):
     # ── 数据完整性检查 ──
     def check_data_integrity(self):
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
+            cursor = self.db.reader.cursor()
 
-            cursor.execute("SELECT image_name FROM image_metadata")
+            cursor.execute(SQL['all_image_names'])
             db_files = set(row[0] for row in cursor.fetchall())
 
             actual_files = set(os.listdir(ARCHIVE_FOLDER))
 
             db_only = db_files - actual_files
             actual_only = actual_files - db_files
+            interrupted = cursor.execute(SQL['journal_committed']).fetchall()
 
             report = f"数据完整性检查报告:\n\n"
             report += f"数据库记录数: {len(db_files)}\n"
@@ -1213,21 +1696,68 @@ class App(tk.Tk):
                     report += f"  • ... 还有 {len(actual_only) - 5} 个\n"
                 report += "\n"
 
-            if not db_only and not actual_only:
-                report += "✓ 数据完整性良好，所有记录都匹配！"
+            if interrupted:
+                report += f"⚠ 入库中断、已写库但未归档: {len(interrupted)} 个\n\n"
 
-            if db_only or actual_only:
-                messagebox.showwarning("数据完整性检查", report)
-            else:
+            if not db_only and not actual_only and not interrupted:
+                report += "✓ 数据完整性良好，所有记录都匹配！"
                 messagebox.showinfo("数据完整性检查", report)
+                return
 
-            conn.close()
+            report += ("是否自动修复？\n"
+                       "  • 入库中断的图片补做归档\n"
+                       "  • 删除文件缺失的记录\n"
+                       f"  • 没有记录的图片移回 {INPUT_FOLDER}，下次处理时重新入库")
+            if messagebox.askyesno("数据完整性检查", report, icon=messagebox.WARNING):
+                self.repair_data()
 
         except Exception as e:
             messagebox.showerror("检查失败", f"数据完整性检查失败: {str(e)}")
 
+    def repair_data(self):
+        """按 repair_archive() 修复中断入库的遗留问题，并同步内存索引与缩略图缓存"""
+        # 入库线程在写库与归档之间的图片会被当成文件缺失的记录
+        if self._worker_thread and self._worker_thread.is_alive():
+            messagebox.showwarning("数据修复", "正在处理或监视文件夹，请结束后再修复")
+            return
+        try:
+            result = repair_archive(self.db.reader)
+        except Exception as e:
+            messagebox.showerror("修复失败", f"数据修复失败: {str(e)}")
+            return
+
+        for image_id, image_name in result['removed']:
+            if self.tag_bitmaps is not None:
+                self.tag_bitmaps.remove(image_id)
+            if self.similarity_index is not None:
+                self.similarity_index.remove(image_id)
+            if image_name in self.current_similar:
+                self.current_similar.remove(image_name)
+            self.thumbnail_cache.discard(image_name)
+            self.thumb_store.delete(image_name)
+        if result['removed']:
+            self._load_tag_index(self.db.reader.cursor())
+        self._invalidate_page_cache()
+        self._refresh_tag_results()
+        self.load_images()
+
+        messagebox.showinfo("数据修复",
+                            f"补做归档: {len(result['moved'])} 张\n"
+                            f"删除文件缺失的记录: {len(result['removed'])} 条\n"
+                            f"移回 {INPUT_FOLDER} 重新入库: {len(result['returned'])} 张")
+
 
 # ── 入口 ──
 if __name__ == '__main__':
-    app = App()
-    app.mainloop()
+    if '--explain' in sys.argv[1:]:
+        explain_queries()
+    elif '--rebuild-tag-stats' in sys.argv[1:]:
+        rebuild_tag_stats_command()
+    elif '--backfill-hashes' in sys.argv[1:]:
+        backfill_hashes()
+    elif '--rethreshold' in sys.argv[1:]:
+        args = sys.argv[sys.argv.index('--rethreshold') + 1:]
+        rethreshold(float(args[0]) if args else PROCESS_THRESHOLD)
+    else:
+        app = App()
+        app.mainloop()
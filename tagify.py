@@ -0,0 +1,2638 @@
+"""
+Tagify 入库引擎 — 配置、数据库、标签索引、模型推理与图片入库流程，不依赖图形界面
+
+main.py（Tk 界面）是它的客户端；没有图形环境的服务器可直接用命令行入库:
+    python -m tagify ingest --input input_image --workers 8
+其余维护命令见 python -m tagify --help。
+"""
+
+import argparse
+import bisect
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+import queue
+import re
+import shutil
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import datetime
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import timm
+import torch
+from PIL import Image, ImageFile
+from safetensors.torch import load_file
+
+# 可选依赖: 安装 pyroaring 后启用标签位图索引，否则计数与筛选全部走 SQLite
+try:
+    from pyroaring import BitMap
+except ImportError:
+    BitMap = None
+
+# 可选依赖: 安装 watchdog 后监视模式用系统文件事件（Linux 上为 inotify）发现新图片，否则定时扫描目录
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+# ── 应用配置加载 ──────────────────────────────────────────
+APP_CONFIG_PATH = 'app_config.json'
+
+def _load_config():
+    """加载 app_config.json，缺失时使用内置默认值"""
+    defaults = {
+        "paths": {
+            "model_path": "model.safetensors",
+            "config_path": "config.json",
+            "tags_csv": "selected_tags.csv",
+            "input_folder": "input_image",
+            "archive_folder": "../deepdanbooru-v3-20211112-sgd-e28 (1)/gallery",
+            "db_file": "image_tags.db",
+            "thumb_db": "thumbnails.db"
+        },
+        "model": {
+            "image_size": [448, 448],
+            "default_threshold": 0.5,
+            "process_threshold": 0.05,
+            "main_tag_threshold": 0.5,
+            "detail_tag_min": 0.05,
+            "valid_extensions": [".png", ".jpg", ".jpeg", ".webp"],
+            "load_truncated_images": True,
+            "batch_size": 8,
+            "decode_workers": 4,
+            "prefetch_depth": 16,
+            "top_k": 0
+        },
+        "ui": {
+            "window_size": [1400, 800],
+            "panel_widths": [300, 700, 400],
+            "thumbnail_size": [150, 150],
+            "thumbnail_cache_bytes": 67108864,
+            "thumbnail_store_format": "WEBP",
+            "thumbnail_workers": 4,
+            "prefetch_pages": 1,
+            "prefetch_budget_mb": 32,
+            "page_size": 20,
+            "default_columns": 4,
+            "thumbnail_padding": 20,
+            "resize_debounce_ms": 150,
+            "scroll_overscan_rows": 2,
+            "search_entry_width": 22,
+            "search_debounce_ms": 100,
+            "search_results_limit": 200,
+            "facet_limit": 15,
+            "tag_button_width": 280,
+            "tag_tree_height": 15,
+            "tag_column_width": 150,
+            "confidence_column_width": 80,
+            "tree_row_height_main": 25,
+            "tree_row_height_detail": 20,
+            "detail_image_max_size": [800, 800],
+            "detail_window_ratio": 0.8,
+            "info_label_width": 8,
+            "pagination_frame_height": 40,
+            "info_frame_width": 380,
+            "colors": {
+                "main_bg": "#f5f5f5",
+                "accent": "#c8ccd0",
+                "detail_bg": "#fafafa"
+            }
+        },
+        "behavior": {
+            "favorite_tag": "collect",
+            "default_sort": "time",
+            "default_order": "DESC",
+            "shutdown_timeout": 3,
+            "pagination_side": 4,
+            "pagination_mode": "keyset",
+            "browse_mode": "pages",
+            "fast_decode": True,
+            "bitmap_index": True,
+            "bitmap_buckets": [0.05, 0.35, 0.5, 0.8],
+            "probability_store": "off",
+            "save_embeddings": False,
+            "similar_top_k": 50,
+            "similar_ivf_lists": 0,
+            "similar_ivf_probe": 8,
+            "duplicate_action": "skip",
+            "perceptual_hash": True,
+            "near_duplicate_distance": 6,
+            "watch_on_start": False,
+            "watch_settle_seconds": 1.0,
+            "watch_poll_seconds": 1.0,
+            "watch_batch_delay": 2.0
+        },
+        "database": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size_mb": 64,
+            "busy_timeout": 5.0,
+            "commit_interval": 32,
+            "statement_cache": 256,
+            "slow_query_ms": 0
+        }
+    }
+
+    try:
+        with open(APP_CONFIG_PATH, 'r', encoding='utf-8') as f:
+            user_cfg = json.load(f)
+        for section in user_cfg:
+            if section in defaults and isinstance(user_cfg[section], dict):
+                defaults[section].update(user_cfg[section])
+        print(f"已加载配置: {APP_CONFIG_PATH}", file=sys.stderr)
+    except FileNotFoundError:
+        print(f"未找到 {APP_CONFIG_PATH}，使用默认配置", file=sys.stderr)
+    except json.JSONDecodeError as e:
+        print(f"配置文件解析失败: {e}，使用默认配置", file=sys.stderr)
+
+    return defaults
+
+_cfg = _load_config()
+_p = _cfg["paths"]
+_m = _cfg["model"]
+_u = _cfg["ui"]
+_b = _cfg["behavior"]
+_d = _cfg["database"]
+
+# ── 路径 ──
+MODEL_PATH   = _p["model_path"]
+CONFIG_PATH  = _p["config_path"]
+TAGS_CSV_PATH = _p["tags_csv"]
+INPUT_FOLDER = _p["input_folder"]
+DB_FILE      = _p["db_file"]
+THUMB_DB_FILE = _p["thumb_db"]
+BITMAP_FILE  = os.path.splitext(DB_FILE)[0] + ".bitmaps"     # 标签位图索引，与数据库放在一起
+PROB_FILE    = os.path.splitext(DB_FILE)[0] + ".probs"       # 完整概率向量库
+EMBED_FILE   = os.path.splitext(DB_FILE)[0] + ".embeddings"  # 图片嵌入向量库
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_FOLDER = os.path.normpath(os.path.join(SCRIPT_DIR, _p["archive_folder"]))
+os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+
+# ── 模型 ──
+IMAGE_SIZE       = tuple(_m["image_size"])
+DEFAULT_THRESHOLD = _m["default_threshold"]
+PROCESS_THRESHOLD = _m["process_threshold"]
+MAIN_TAG_THRESHOLD = _m["main_tag_threshold"]
+DETAIL_TAG_MIN    = _m["detail_tag_min"]
+VALID_EXTENSIONS  = tuple(_m["valid_extensions"])
+ImageFile.LOAD_TRUNCATED_IMAGES = _m["load_truncated_images"]
+BATCH_SIZE        = max(1, _m["batch_size"])
+DECODE_WORKERS    = _m["decode_workers"]
+PREFETCH_DEPTH    = _m["prefetch_depth"]
+TOP_K             = _m["top_k"]
+
+# ── UI ──
+WINDOW_SIZE      = f"{_u['window_size'][0]}x{_u['window_size'][1]}"
+PANEL_LEFT_W     = _u["panel_widths"][0]
+PANEL_CENTER_W   = _u["panel_widths"][1]
+PANEL_RIGHT_W    = _u["panel_widths"][2]
+THUMB_SIZE       = tuple(_u["thumbnail_size"])
+THUMB_CACHE_BYTES = _u["thumbnail_cache_bytes"]
+THUMB_STORE_FMT  = _u["thumbnail_store_format"]
+THUMB_WORKERS    = _u["thumbnail_workers"]
+PREFETCH_PAGES   = _u["prefetch_pages"]
+PREFETCH_BUDGET  = _u["prefetch_budget_mb"] * 1024 * 1024
+THUMB_BYTES      = THUMB_SIZE[0] * THUMB_SIZE[1] * 4     # 单张缩略图内存上限估算（RGBA）
+PAGE_SIZE        = _u["page_size"]
+DEFAULT_COLUMNS  = _u["default_columns"]
+THUMB_PADDING    = _u["thumbnail_padding"]
+RESIZE_DEBOUNCE  = _u["resize_debounce_ms"]
+SCROLL_OVERSCAN  = _u["scroll_overscan_rows"]
+SEARCH_ENTRY_W   = _u["search_entry_width"]
+SEARCH_DEBOUNCE  = _u["search_debounce_ms"]
+SEARCH_LIMIT     = _u["search_results_limit"]
+FACET_LIMIT      = _u["facet_limit"]
+TAG_BUTTON_W     = _u["tag_button_width"]
+TAG_TREE_HEIGHT  = _u["tag_tree_height"]
+TAG_COL_W        = _u["tag_column_width"]
+CONF_COL_W       = _u["confidence_column_width"]
+TREE_ROW_MAIN    = _u["tree_row_height_main"]
+TREE_ROW_DETAIL  = _u["tree_row_height_detail"]
+DETAIL_IMG_MAX   = tuple(_u["detail_image_max_size"])
+DETAIL_WIN_RATIO = _u["detail_window_ratio"]
+INFO_LABEL_W     = _u["info_label_width"]
+PAGINATION_H     = _u["pagination_frame_height"]
+INFO_FRAME_W     = _u["info_frame_width"]
+MAIN_COLOR       = _u["colors"]["main_bg"]
+ACCENT_COLOR     = _u["colors"]["accent"]
+DETAIL_COLOR     = _u["colors"]["detail_bg"]
+
+# ── 行为 ──
+FAVORITE_TAG     = _b["favorite_tag"]
+DEFAULT_SORT     = _b["default_sort"]
+DEFAULT_ORDER    = _b["default_order"]
+SHUTDOWN_TIMEOUT = _b["shutdown_timeout"]
+PAGINATION_SIDE  = _b["pagination_side"]
+PAGINATION_MODE  = _b["pagination_mode"]
+BROWSE_MODE      = _b["browse_mode"]
+FAST_DECODE      = _b["fast_decode"]
+BITMAP_INDEX     = _b["bitmap_index"] and BitMap is not None
+BITMAP_BUCKETS   = tuple(sorted(_b["bitmap_buckets"]))
+PROB_STORE       = _b["probability_store"]      # "off" / "float16" / "uint8"
+SAVE_EMBEDDINGS  = _b["save_embeddings"]
+SIMILAR_TOP_K    = _b["similar_top_k"]
+SIMILAR_IVF_LISTS = _b["similar_ivf_lists"]
+SIMILAR_IVF_PROBE = _b["similar_ivf_probe"]
+DUPLICATE_ACTION = _b["duplicate_action"]       # "skip" / "copy"
+PERCEPTUAL_HASH  = _b["perceptual_hash"]
+NEAR_DUP_DISTANCE = _b["near_duplicate_distance"]
+WATCH_ON_START   = _b["watch_on_start"]
+WATCH_SETTLE     = _b["watch_settle_seconds"]
+WATCH_POLL       = _b["watch_poll_seconds"]
+WATCH_BATCH_DELAY = _b["watch_batch_delay"]
+# ── 数据库 ──
+DB_JOURNAL_MODE  = _d["journal_mode"]
+DB_SYNCHRONOUS   = _d["synchronous"]
+DB_CACHE_MB      = _d["cache_size_mb"]
+DB_BUSY_TIMEOUT  = _d["busy_timeout"]
+COMMIT_INTERVAL  = max(1, _d["commit_interval"])     # 入库时每个事务写入的图片数
+DB_STATEMENT_CACHE = _d["statement_cache"]
+DB_SLOW_QUERY_MS = _d["slow_query_ms"]              # 0 表示不打印慢查询
+
+# 缩放时先按整数倍 reduce() 再精细重采样；None 表示始终从全分辨率重采样
+REDUCING_GAP     = 3.0 if FAST_DECODE else None
+
+
+# ── 数据库结构与 SQL 语句 ──────────────────────────────────
+# 应用发出的所有查询集中在 SQL 中，便于 `python -m tagify explain` 逐条输出查询计划。
+# 分页模板中的 {key} / {seek} / {order} / {filter} 由 page_query() 填入，{filter} 为 TagQuery 的附加条件。
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS images
+       (
+           id           INTEGER PRIMARY KEY,
+           name         TEXT NOT NULL UNIQUE,
+           file_size    INTEGER,
+           process_time TEXT
+       )''',
+    '''CREATE TABLE IF NOT EXISTS tag_vocab
+       (
+           id   INTEGER PRIMARY KEY,
+           name TEXT NOT NULL UNIQUE
+       )''',
+    '''CREATE TABLE IF NOT EXISTS image_tags
+       (
+           image_id   INTEGER NOT NULL REFERENCES images (id),
+           tag_id     INTEGER NOT NULL REFERENCES tag_vocab (id),
+           confidence REAL,
+           PRIMARY KEY (image_id, tag_id)
+       ) WITHOUT ROWID''',
+    # 按标签浏览/计数：覆盖索引，tag_id 定位后无需回表即可取到置信度与 image_id
+    "CREATE INDEX IF NOT EXISTS idx_image_tags_tag ON image_tags (tag_id, confidence, image_id)",
+    # 图库排序；name 作为同值时的次序键
+    "CREATE INDEX IF NOT EXISTS idx_images_time ON images (process_time, name)",
+    "CREATE INDEX IF NOT EXISTS idx_images_size ON images (file_size, name)",
+    # 完整概率向量在 PROB_FILE 中的行号（追加写入，图片重新处理后指向新行）
+    '''CREATE TABLE IF NOT EXISTS image_probs
+       (
+           image_id INTEGER PRIMARY KEY REFERENCES images (id),
+           row      INTEGER NOT NULL
+       )''',
+    # 嵌入向量在 EMBED_FILE 中的行号
+    '''CREATE TABLE IF NOT EXISTS image_embeddings
+       (
+           image_id INTEGER PRIMARY KEY REFERENCES images (id),
+           row      INTEGER NOT NULL
+       )''',
+    # 每个标签的图片数 / 置信度之和 / 最高置信度，由下面的触发器随 image_tags 增量维护，
+    # 标签计数只需按主键读一行；可用 `python -m tagify rebuild-tag-stats` 从 image_tags 重建
+    '''CREATE TABLE IF NOT EXISTS tag_stats
+       (
+           tag_id      INTEGER PRIMARY KEY REFERENCES tag_vocab (id),
+           image_count INTEGER NOT NULL,
+           sum_conf    REAL    NOT NULL,
+           max_conf    REAL
+       )''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_image_tags_insert
+       AFTER INSERT ON image_tags
+       BEGIN
+           INSERT INTO tag_stats (tag_id, image_count, sum_conf, max_conf)
+           VALUES (NEW.tag_id, 1, COALESCE(NEW.confidence, 0), NEW.confidence)
+           ON CONFLICT (tag_id) DO UPDATE
+               SET image_count = image_count + 1,
+                   sum_conf    = sum_conf + excluded.sum_conf,
+                   max_conf    = MAX(COALESCE(max_conf, 0), COALESCE(excluded.max_conf, 0));
+       END''',
+    # 最高置信度无法减量维护，删除/修改时借 idx_image_tags_tag 直接取该标签的 MAX
+    '''CREATE TRIGGER IF NOT EXISTS trg_image_tags_delete
+       AFTER DELETE ON image_tags
+       BEGIN
+           UPDATE tag_stats
+           SET image_count = image_count - 1,
+               sum_conf    = sum_conf - COALESCE(OLD.confidence, 0),
+               max_conf    = (SELECT MAX(confidence) FROM image_tags WHERE tag_id = OLD.tag_id)
+           WHERE tag_id = OLD.tag_id;
+           DELETE FROM tag_stats WHERE tag_id = OLD.tag_id AND image_count <= 0;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_image_tags_update
+       AFTER UPDATE OF confidence ON image_tags
+       BEGIN
+           UPDATE tag_stats
+           SET sum_conf = sum_conf - COALESCE(OLD.confidence, 0) + COALESCE(NEW.confidence, 0),
+               max_conf = (SELECT MAX(confidence) FROM image_tags WHERE tag_id = NEW.tag_id)
+           WHERE tag_id = NEW.tag_id;
+       END''',
+    # 入库日志: 每张图片的入库进度，中断后据此续做（见 IngestEngine._resume()）
+    # queued 待推理 → inferred 已推理（记下标签与向量行号）→ committed 已写库 → moved 已移入归档目录
+    '''CREATE TABLE IF NOT EXISTS ingest_journal
+       (
+           src_path     TEXT PRIMARY KEY,
+           state        TEXT NOT NULL,
+           content_hash BLOB,
+           phash        INTEGER,
+           tags         TEXT,
+           prob_row     INTEGER,
+           embed_row    INTEGER,
+           dest_name    TEXT,
+           updated      TEXT
+       )''',
+]
+
+# 后续版本给已有表新增的列: create_schema() 对旧库用 ALTER TABLE 补齐，再建依赖这些列的索引
+COLUMNS = [
+    ('images', 'content_hash', 'BLOB'),     # 文件内容的 BLAKE2b 摘要，识别完全相同的图片
+    ('images', 'phash', 'INTEGER'),         # 64 位感知哈希，发现近似重复的图片
+]
+COLUMN_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_images_hash ON images (content_hash)",
+    "CREATE INDEX IF NOT EXISTS idx_images_phash ON images (phash)",
+]
+
+SQL = {
+    # 标签搜索: 启动时读入 TagIndex，之后搜索不再查询数据库
+    'tag_counts': '''SELECT v.name, s.image_count
+                    FROM tag_stats s
+                        JOIN tag_vocab v ON v.id = s.tag_id''',
+    # 图片信息
+    'image_info': '''SELECT file_size, process_time
+                    FROM images
+                    WHERE name = ?''',
+    'image_tags': '''SELECT v.name, it.confidence
+                    FROM image_tags it
+                        JOIN images i ON i.id = it.image_id
+                        JOIN tag_vocab v ON v.id = it.tag_id
+                    WHERE i.name = ?
+                    ORDER BY it.confidence DESC''',
+    # 收藏
+    'has_tag': '''SELECT 1
+                 FROM image_tags it
+                     JOIN images i ON i.id = it.image_id
+                     JOIN tag_vocab v ON v.id = it.tag_id
+                 WHERE i.name = ?
+                   AND v.name = ?''',
+    'remove_tag': '''DELETE
+                    FROM image_tags
+                    WHERE image_id = (SELECT id FROM images WHERE name = ?)
+                      AND tag_id = (SELECT id FROM tag_vocab WHERE name = ?)''',
+    'add_vocab': "INSERT OR IGNORE INTO tag_vocab (name) VALUES (?)",
+    # REPLACE 删除旧行时不触发 DELETE 触发器，改用 UPSERT 保证 tag_stats 不重复计数
+    'add_tag': '''INSERT INTO image_tags (image_id, tag_id, confidence)
+                 SELECT i.id, v.id, ?
+                 FROM images i, tag_vocab v
+                 WHERE i.name = ?
+                   AND v.name = ?
+                 ON CONFLICT (image_id, tag_id) DO UPDATE SET confidence = excluded.confidence''',
+    # 删除
+    'delete_image_tags': "DELETE FROM image_tags WHERE image_id = (SELECT id FROM images WHERE name = ?)",
+    'delete_image_probs': "DELETE FROM image_probs WHERE image_id = (SELECT id FROM images WHERE name = ?)",
+    'delete_image_embedding': '''DELETE
+                                FROM image_embeddings
+                                WHERE image_id = (SELECT id FROM images WHERE name = ?)''',
+    'delete_image': "DELETE FROM images WHERE name = ?",
+    # 浏览
+    'gallery_count': "SELECT COUNT(*) FROM images",
+    'gallery_page': '''SELECT name, {key}
+                      FROM images
+                      WHERE {filter}
+                        AND {seek}
+                      ORDER BY {order}
+                      LIMIT ? OFFSET ?''',
+    # 读 tag_stats 一行，不再扫描该标签的全部 image_tags；标签无图片时没有这一行
+    'tag_count': '''SELECT image_count
+                   FROM tag_stats
+                   WHERE tag_id = (SELECT id FROM tag_vocab WHERE name = ?)''',
+    'tag_page': '''SELECT i.name, {key}
+                  FROM image_tags it
+                      JOIN images i ON i.id = it.image_id
+                  WHERE it.tag_id = (SELECT id FROM tag_vocab WHERE name = ?)
+                    AND {filter}
+                    AND {seek}
+                  ORDER BY {order}
+                  LIMIT ? OFFSET ?''',
+    # 多标签查询（TagQuery）
+    'query_tag_stats': '''SELECT v.id, COALESCE(s.image_count, 0)
+                         FROM tag_vocab v
+                             LEFT JOIN tag_stats s ON s.tag_id = v.id
+                         WHERE v.name = ?''',
+    'query_tag_count': '''SELECT COUNT(*)
+                         FROM image_tags it
+                         WHERE it.tag_id = (SELECT id FROM tag_vocab WHERE name = ?)
+                           AND {filter}''',
+    'query_gallery_count': '''SELECT COUNT(*)
+                             FROM images
+                             WHERE {filter}''',
+    'tag_name': "SELECT name FROM tag_vocab WHERE id = ?",
+    # 批量处理
+    'vocab_ids': "SELECT name, id FROM tag_vocab",
+    'image_id': "SELECT id FROM images WHERE name = ?",
+    'image_tag_names': '''SELECT v.name
+                         FROM image_tags it
+                             JOIN tag_vocab v ON v.id = it.tag_id
+                         WHERE it.image_id = ?''',
+    'clear_image_tags': "DELETE FROM image_tags WHERE image_id = ?",
+    'delete_image_prob_id': "DELETE FROM image_probs WHERE image_id = ?",
+    'insert_image_prob': "INSERT OR REPLACE INTO image_probs (image_id, row) VALUES (?, ?)",
+    'delete_image_embedding_id': "DELETE FROM image_embeddings WHERE image_id = ?",
+    'insert_image_embedding': "INSERT OR REPLACE INTO image_embeddings (image_id, row) VALUES (?, ?)",
+    # 相似图片
+    'embedding_rows': "SELECT image_id, row FROM image_embeddings",
+    'embedding_row': '''SELECT e.image_id, e.row
+                       FROM image_embeddings e
+                           JOIN images i ON i.id = e.image_id
+                       WHERE i.name = ?''',
+    'image_name_by_id': "SELECT name FROM images WHERE id = ?",
+    # 同名记录已存在时原地更新（沿用 id），不必先删后插
+    'upsert_image': '''INSERT INTO images (name, file_size, process_time, content_hash, phash)
+                      VALUES (?, ?, ?, ?, ?)
+                      ON CONFLICT (name) DO UPDATE SET file_size    = excluded.file_size,
+                                                       process_time = excluded.process_time,
+                                                       content_hash = excluded.content_hash,
+                                                       phash        = excluded.phash''',
+    # 去重
+    'image_by_hash': "SELECT id, name FROM images WHERE content_hash = ? LIMIT 1",
+    'content_hashes': "SELECT content_hash, name FROM images WHERE content_hash IS NOT NULL",
+    'perceptual_hashes': "SELECT name, phash FROM images WHERE phash IS NOT NULL",
+    'image_tag_rows': '''SELECT it.tag_id, v.name, it.confidence
+                        FROM image_tags it
+                            JOIN tag_vocab v ON v.id = it.tag_id
+                        WHERE it.image_id = ?''',
+    'image_prob_row': "SELECT row FROM image_probs WHERE image_id = ?",
+    'image_embedding_row': "SELECT row FROM image_embeddings WHERE image_id = ?",
+    'images_without_hash': "SELECT id, name FROM images WHERE content_hash IS NULL",
+    'set_image_hashes': "UPDATE images SET content_hash = ?, phash = ? WHERE id = ?",
+    'insert_image_tags': '''INSERT INTO image_tags (image_id, tag_id, confidence)
+                           VALUES (?, ?, ?)''',
+    # 入库日志（tags 为 JSON [[tag_id, 标签名, 置信度]]）
+    'journal_queue': '''INSERT INTO ingest_journal (src_path, state, content_hash, phash, updated)
+                       VALUES (?, 'queued', ?, ?, ?)
+                       ON CONFLICT (src_path) DO UPDATE SET state        = 'queued',
+                                                            content_hash = excluded.content_hash,
+                                                            phash        = excluded.phash,
+                                                            tags         = NULL,
+                                                            prob_row     = NULL,
+                                                            embed_row    = NULL,
+                                                            dest_name    = NULL,
+                                                            updated      = excluded.updated''',
+    'journal_infer': '''UPDATE ingest_journal
+                       SET state = 'inferred', tags = ?, prob_row = ?, embed_row = ?, updated = ?
+                       WHERE src_path = ?''',
+    'journal_commit': '''INSERT INTO ingest_journal (src_path, state, content_hash, phash, dest_name, updated)
+                        VALUES (?, 'committed', ?, ?, ?, ?)
+                        ON CONFLICT (src_path) DO UPDATE SET state     = 'committed',
+                                                             dest_name = excluded.dest_name,
+                                                             updated   = excluded.updated''',
+    'journal_moved': "UPDATE ingest_journal SET state = 'moved', updated = ? WHERE src_path = ?",
+    'journal_inferred': """SELECT src_path, content_hash, phash, tags, prob_row, embed_row
+                          FROM ingest_journal
+                          WHERE state = 'inferred'""",
+    'journal_committed': """SELECT src_path, dest_name, content_hash
+                           FROM ingest_journal
+                           WHERE state = 'committed'""",
+    'journal_delete': "DELETE FROM ingest_journal WHERE src_path = ?",
+    # 待推理的行只说明上次推理前中断，文件仍在输入目录，重新处理即可
+    'journal_prune': "DELETE FROM ingest_journal WHERE state IN ('queued', 'moved')",
+    # 完整性检查
+    'all_image_names': "SELECT name FROM images",
+    'all_images': "SELECT id, name FROM images",
+    'delete_image_id': "DELETE FROM images WHERE id = ?",
+    # 标签位图索引
+    'bitmap_fingerprint': '''SELECT (SELECT COUNT(*) FROM images),
+                                  (SELECT COALESCE(MAX(id), 0) FROM images),
+                                  (SELECT TOTAL(image_count) FROM tag_stats)''',
+    'bitmap_images': "SELECT id FROM images",
+    'bitmap_rows': "SELECT tag_id, image_id, confidence FROM image_tags",
+    # 按新阈值重建标签（--rethreshold）
+    'prob_rows': "SELECT image_id, row FROM image_probs ORDER BY image_id",
+    'image_tag_ids': "SELECT tag_id FROM image_tags WHERE image_id = ?",
+    'remove_image_tag': "DELETE FROM image_tags WHERE image_id = ? AND tag_id = ?",
+    # 重建 tag_stats
+    'clear_tag_stats': "DELETE FROM tag_stats",
+    'rebuild_tag_stats': '''INSERT INTO tag_stats (tag_id, image_count, sum_conf, max_conf)
+                           SELECT tag_id, COUNT(*), TOTAL(confidence), MAX(confidence)
+                           FROM image_tags
+                           GROUP BY tag_id''',
+}
+
+# load_images() 的排序字段（图库视图 / 标签视图）
+GALLERY_SORT = {
+    'name': 'name',
+    'size': 'file_size',
+    'time': 'process_time',
+}
+TAG_SORT = {
+    'name': 'i.name',
+    'size': 'i.file_size',
+    'time': 'i.process_time',
+    'confidence': 'it.confidence',
+}
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """每次 execute / executemany 后把 (SQL, 耗时秒数) 交给所属连接的 on_query"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.on_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.on_query(sql, time.perf_counter() - start)
+
+
+class _TimedConnection(sqlite3.Connection):
+    """cursor() 返回计时游标；conn.execute() 等快捷方法不经过 cursor()，这里一并改走计时游标"""
+
+    on_query = None
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect(db_file=DB_FILE, on_query=None, **kwargs):
+    """打开数据库连接，应用 database 配置中的日志模式、同步级别、页缓存与忙等待超时
+
+    WAL 模式下读写互不阻塞，界面浏览时后台可以同时入库；synchronous=NORMAL 时提交不再
+    逐次 fsync，只在检查点同步，断电最多丢失最近几次提交，数据库本身不会损坏。
+    on_query(sql, 秒数) 在每条语句执行后调用；其余参数原样传给 sqlite3.connect()。
+    """
+    if on_query is not None:
+        kwargs['factory'] = _TimedConnection
+    conn = sqlite3.connect(db_file, timeout=DB_BUSY_TIMEOUT, **kwargs)
+    if on_query is not None:
+        conn.on_query = on_query
+    conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = {-int(DB_CACHE_MB * 1024)}")
+    return conn
+
+
+class QueryTimer:
+    """查询计时钩子: 按语句累计执行次数、总耗时与最长耗时，超过 slow_ms 的查询打印到控制台
+
+    语句按 SQL 中的名字归类，分页等动态生成的语句取前 60 个字符。可同时挂在多条连接上。
+    """
+
+    def __init__(self, slow_ms=DB_SLOW_QUERY_MS):
+        self.slow_ms = slow_ms
+        self._labels = {sql: name for name, sql in SQL.items()}
+        self._stats = {}        # 语句名 → [次数, 总耗时, 最长耗时]
+        self._lock = threading.Lock()
+
+    def __call__(self, sql, seconds):
+        label = self._labels.get(sql)
+        if label is None:
+            label = self._labels[sql] = " ".join(sql.split())[:60]
+        with self._lock:
+            entry = self._stats.setdefault(label, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+        if self.slow_ms and seconds * 1000 >= self.slow_ms:
+            print(f"慢查询 {seconds * 1000:.1f} ms: {label}")
+
+    def top(self, limit=5):
+        """总耗时最多的 limit 条语句: [(语句名, 次数, 总耗时, 最长耗时)]"""
+        with self._lock:
+            rows = [(label, *entry) for label, entry in self._stats.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)[:limit]
+
+
+class ConnectionManager:
+    """长期持有的数据库连接，首次使用时打开，之后一直复用
+
+    reader  界面线程的连接: 保留页缓存与预编译语句缓存（statement_cache 条），浏览、搜索、
+            查看详情不再每次建连和预热缓存。收藏、删除等界面上的少量写操作也用它提交。
+    writer  入库线程的写连接（IngestEngine 使用），可交给之后的处理线程继续复用，
+            同一时间只应有一个线程使用。WAL 模式下与 reader 互不阻塞。
+    两条连接的每条语句都交给 on_query(sql, 秒数) 计时（如 QueryTimer）。
+    """
+
+    def __init__(self, db_file=DB_FILE, on_query=None):
+        self.db_file = db_file
+        self.on_query = on_query
+        self._reader = None
+        self._writer = None
+        self._lock = threading.Lock()
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            self._reader = connect(self.db_file, self.on_query, cached_statements=DB_STATEMENT_CACHE)
+        return self._reader
+
+    @property
+    def writer(self):
+        with self._lock:
+            if self._writer is None:
+                self._writer = connect(self.db_file, self.on_query, cached_statements=DB_STATEMENT_CACHE,
+                                       check_same_thread=False)
+            return self._writer
+
+    def close(self):
+        with self._lock:
+            for conn in (self._reader, self._writer):
+                if conn is not None:
+                    conn.close()
+            self._reader = self._writer = None
+
+
+def create_schema(cursor):
+    """建表建索引，给旧库补齐 COLUMNS 中的新增列（可重复执行）"""
+    for statement in SCHEMA:
+        cursor.execute(statement)
+    for table, column, declaration in COLUMNS:
+        if column not in {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+    for statement in COLUMN_INDEXES:
+        cursor.execute(statement)
+
+
+def page_query(view_mode, sort_by, sort_order, seek=False, filter_sql='1'):
+    """拼出分页查询：按排序键排序、name 作次序键保证顺序稳定
+
+    seek=True 时附加 (key, name) 行值比较，从上一页最后一行之后继续取（键集分页），
+    此时需在标签参数与 filter_sql 的参数之后绑定 page_anchor() 返回的边界值。
+    """
+    if view_mode == "gallery":
+        template, key, name = SQL['gallery_page'], GALLERY_SORT[sort_by], 'name'
+    else:
+        template, key, name = SQL['tag_page'], TAG_SORT[sort_by], 'i.name'
+
+    op = '>' if sort_order == 'ASC' else '<'
+    if key == name:
+        seek_sql = f"{name} {op} ?"
+        order = f"{name} {sort_order}"
+    else:
+        seek_sql = f"({key}, {name}) {op} (?, ?)"
+        order = f"{key} {sort_order}, {name} {sort_order}"
+
+    return template.format(key=key, seek=seek_sql if seek else '1', order=order, filter=filter_sql)
+
+
+def page_anchor(row):
+    """由分页查询的一行 (name, key) 得到键集分页边界值"""
+    name, key = row
+    return (name,) if key == name else (key, name)
+
+
+def explain_queries(db_file=DB_FILE):
+    """输出应用所有查询的 EXPLAIN QUERY PLAN（分页查询按排序字段与偏移/键集两种方式展开）"""
+    conn = connect(db_file)
+    try:
+        cursor = conn.cursor()
+        create_schema(cursor)
+        conn.commit()
+
+        for name, sql in SQL.items():
+            if '{order}' in sql:
+                view_mode = "gallery" if name.startswith('gallery') else "tag"
+                columns = GALLERY_SORT if view_mode == "gallery" else TAG_SORT
+                variants = [(f"{name} [{key}{', seek' if seek else ''}]",
+                             page_query(view_mode, key, 'DESC', seek))
+                            for key in columns for seek in (False, True)]
+            else:
+                variants = [(name, sql.replace('{filter}', '1'))]
+
+            for label, query in variants:
+                # 计划与参数取值无关，占位符统一绑定 NULL
+                plan = cursor.execute(f"EXPLAIN QUERY PLAN {query}", (None,) * query.count('?')).fetchall()
+                print(f"── {label}")
+                for _, parent, _, detail in plan:
+                    print(f"   {'  ' * (parent > 0)}{detail}")
+    finally:
+        conn.close()
+
+
+def rebuild_tag_stats(cursor):
+    """从 image_tags 全量重算 tag_stats（新建该表或怀疑统计不一致时使用），返回标签数"""
+    cursor.execute(SQL['clear_tag_stats'])
+    cursor.execute(SQL['rebuild_tag_stats'])
+    return cursor.rowcount
+
+
+def rebuild_tag_stats_command(db_file=DB_FILE):
+    """命令行入口: python -m tagify rebuild-tag-stats"""
+    conn = connect(db_file)
+    try:
+        cursor = conn.cursor()
+        create_schema(cursor)
+        print(f"已重建 tag_stats: {rebuild_tag_stats(cursor)} 个标签")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ── 多标签查询 ────────────────────────────────────────────
+QueryTerm = namedtuple('QueryTerm', 'tag op conf negated')
+
+
+class TagQuery:
+    """多标签布尔查询：标签之间用 AND（可省略）或 OR 连接，NOT 取反，标签后可跟最低置信度
+
+        1girl AND hug OR kiss AND NOT monochrome AND smile>0.7
+
+    OR 比 AND 结合得紧，上例即 1girl 且 (hug 或 kiss) 且非 monochrome 且 smile>0.7；
+    OR 连接的标签不能带 NOT。解析后也可在代码中直接使用（cursor 为标签数据库的游标）:
+        query = TagQuery.parse("1girl smile>=0.7")
+        total = query.count(cursor)
+        rows = query.page(cursor, 'time', 'DESC', limit=20)     # [(图片名, 排序键)]
+
+    求值时单独的正向标签按 tag_stats 中的图片数从少到多排列：最稀有的标签经 idx_image_tags_tag
+    取候选行并作分页查询的主表，其余条件按主键 (image_id, tag_id) 逐行判断。
+    没有单独的正向标签时以 images 为主表。
+    """
+
+    _COMPARE = re.compile(r'^(.+?)(>=|>)([0-9]*\.?[0-9]+)$')
+    _KEYWORDS = ('AND', 'OR', 'NOT')
+
+    def __init__(self, groups):
+        """groups 为 [[QueryTerm]]: 组之间 AND，组内 OR"""
+        self.groups = [list(group) for group in groups]
+        self.terms = [term for group in self.groups for term in group]
+
+    @classmethod
+    def for_tag(cls, tag):
+        """只含一个标签的查询（标签视图的分面统计用）"""
+        return cls([[QueryTerm(tag, None, None, False)]])
+
+    def __str__(self):
+        return " AND ".join(" OR ".join(f"{'NOT ' if term.negated else ''}{term.tag}"
+                                        f"{f'{term.op}{term.conf:g}' if term.op else ''}" for term in group)
+                            for group in self.groups)
+
+    @classmethod
+    def parse(cls, text):
+        """解析查询文本，语法错误时抛出 ValueError"""
+        groups, negated, joiner = [], False, 'AND'     # joiner: 下一个标签与前面的连接方式，None 表示刚读完标签
+        for token in text.split():
+            word = token.upper()
+            if word in ('AND', 'OR'):
+                if joiner is not None:
+                    raise ValueError(f"{word} 两侧都需要标签")
+                joiner = word
+            elif word == 'NOT':
+                if negated:
+                    raise ValueError("NOT 后需要标签")
+                negated = True
+            else:
+                tag, op, conf = token, None, None
+                match = cls._COMPARE.match(token)
+                if match:
+                    tag, op, conf = match.group(1), match.group(2), float(match.group(3))
+                    if not 0 <= conf <= 1:
+                        raise ValueError(f"置信度需在 0~1 之间: {token}")
+                term = QueryTerm(tag, op, conf, negated)
+                if joiner == 'OR':
+                    if negated or groups[-1][0].negated:
+                        raise ValueError("OR 连接的标签不能用 NOT")
+                    groups[-1].append(term)
+                else:
+                    groups.append([term])
+                negated, joiner = False, None
+
+        if negated or (joiner is not None and groups):
+            raise ValueError("查询不能以 AND / OR / NOT 结尾")
+        if not groups:
+            raise ValueError("查询中没有标签")
+        return cls(groups)
+
+    @classmethod
+    def is_query(cls, text):
+        """是否需要按查询处理（多个标签、含 AND / NOT 或置信度条件），而不是单个标签名"""
+        tokens = text.split()
+        return len(tokens) > 1 or any(cls._COMPARE.match(token) for token in tokens)
+
+    @classmethod
+    def completion_prefix(cls, text):
+        """查询文本中正在输入的标签（最后一个词去掉置信度条件），供搜索框补全"""
+        tokens = text.split()
+        if not tokens or tokens[-1].upper() in cls._KEYWORDS:
+            return ""
+        return re.sub(r'(?<=.)>=?[0-9]*\.?[0-9]*$', '', tokens[-1])
+
+    def _compile(self, cursor):
+        """按当前 tag_stats 决定求值顺序，返回 (主表标签, 附加条件 SQL, 参数)
+
+        某个正向标签（或 OR 组中的全部标签）没有任何图片时结果必为空，返回 None。
+        """
+        positives, negatives, alternatives = [], [], []
+        for group in self.groups:
+            options = []
+            for term in group:
+                tag_id, count = cursor.execute(SQL['query_tag_stats'], (term.tag,)).fetchone() or (None, 0)
+                if term.negated:
+                    if tag_id is not None:
+                        negatives.append((term, tag_id))
+                elif count:
+                    options.append((count, term, tag_id))
+            if group[0].negated:
+                continue
+            if not options:
+                return None
+            if len(group) == 1:
+                positives += options
+            else:
+                alternatives.append(options)
+        positives.sort(key=lambda item: item[0])
+
+        driver = positives[0][1] if positives else None
+        image_id = 'it.image_id' if driver else 'images.id'
+        clauses, params = [], []
+        if driver is not None and driver.op:
+            clauses.append(f"it.confidence {driver.op} ?")
+            params.append(driver.conf)
+
+        def exists(term, tag_id):
+            sql = f"SELECT 1 FROM image_tags q WHERE q.image_id = {image_id} AND q.tag_id = ?"
+            params.append(tag_id)
+            if term.op:
+                sql += f" AND q.confidence {term.op} ?"
+                params.append(term.conf)
+            return f"{'NOT ' if term.negated else ''}EXISTS ({sql})"
+
+        conditions = [(term, tag_id) for _, term, tag_id in positives[1:]] + negatives
+        for term, tag_id in conditions:
+            clauses.append(exists(term, tag_id))
+        for options in alternatives:
+            clauses.append("(" + " OR ".join(exists(term, tag_id) for _, term, tag_id in options) + ")")
+        return driver, " AND ".join(clauses) or '1', tuple(params)
+
+    def select(self, cursor, bitmaps):
+        """用 TagBitmapIndex 求出符合查询的图片 ID 集合；有置信度条件不对应任何分桶时返回 None"""
+        all_of, any_of, none_of = [], [], []
+        for group in self.groups:
+            keys = []
+            for term in group:
+                level = bitmaps.level(term.op, term.conf)
+                if level is None:
+                    return None
+                tag_id, _ = cursor.execute(SQL['query_tag_stats'], (term.tag,)).fetchone() or (None, 0)
+                if tag_id is not None:
+                    keys.append((tag_id, level))
+            if group[0].negated:
+                none_of += keys
+            elif not keys:
+                return BitMap()
+            elif len(group) == 1:
+                all_of += keys
+            else:
+                any_of.append(keys)
+        return bitmaps.select(all_of=all_of, any_of=any_of, none_of=none_of)
+
+    def facets(self, cursor, bitmaps, limit=FACET_LIMIT):
+        """结果中最常见的其他标签 [(标签名, 图片数)]，用位图统计；条件无法由位图表示时返回 None"""
+        selection = self.select(cursor, bitmaps)
+        if selection is None:
+            return None
+        exclude = {term.tag for term in self.terms}
+        result = []
+        for tag_id, count in bitmaps.facets(selection, limit=limit + len(exclude)):
+            row = cursor.execute(SQL['tag_name'], (tag_id,)).fetchone()
+            if row and row[0] not in exclude:
+                result.append((row[0], count))
+        return result[:limit]
+
+    def count(self, cursor, bitmaps=None):
+        """符合查询的图片数；给出 bitmaps 且条件都能由位图表示时不查 image_tags"""
+        if bitmaps is not None:
+            selection = self.select(cursor, bitmaps)
+            if selection is not None:
+                return len(selection)
+
+        plan = self._compile(cursor)
+        if plan is None:
+            return 0
+        driver, filter_sql, params = plan
+        if driver is None:
+            cursor.execute(SQL['query_gallery_count'].format(filter=filter_sql), params)
+        else:
+            cursor.execute(SQL['query_tag_count'].format(filter=filter_sql), (driver.tag,) + params)
+        return cursor.fetchone()[0]
+
+    def page(self, cursor, sort_by, sort_order, limit, offset=0, anchor=()):
+        """按与 load_images() 相同的排序取一页 [(图片名, 排序键)]；anchor 为 page_anchor() 的键集边界"""
+        plan = self._compile(cursor)
+        if plan is None:
+            return []
+        driver, filter_sql, params = plan
+        if driver is None:
+            if sort_by not in GALLERY_SORT:
+                raise ValueError(f"没有正向标签的查询不支持按 {sort_by} 排序")
+            sql = page_query("gallery", sort_by, sort_order, bool(anchor), filter_sql)
+        else:
+            sql = page_query("tag", sort_by, sort_order, bool(anchor), filter_sql)
+            params = (driver.tag,) + params
+        return cursor.execute(sql, params + tuple(anchor) + (limit, offset)).fetchall()
+
+
+# ── 标签搜索索引 ──────────────────────────────────────────
+class TagIndex:
+    """内存中的标签词表与每个标签的图片数，供搜索框边输入边查询
+
+    前缀查找用按小写名排序的数组二分；子串查找用长度 1..GRAM 的子串 → 标签名倒排表，
+    更长的关键词取其所有 GRAM 长子串中最短的倒排表作候选再逐个验证。
+    计数在入库、收藏、删除时增量更新，可在处理线程中调用。
+    """
+
+    GRAM = 3
+
+    def __init__(self):
+        self._keys = []         # [(小写名, 标签名)]，有序
+        self._grams = {}        # 子串 → {标签名}
+        self._counts = {}       # 标签名 → 图片数
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def load(self, names, counts):
+        """用词表与 {标签名: 图片数} 重建索引"""
+        with self._lock:
+            self._keys, self._grams, self._counts = [], {}, {}
+            for name in names:
+                self._add(name)
+            for name, count in counts.items():
+                self._add(name)
+                self._counts[name] = count
+
+    def _add(self, name):
+        """加入新标签（调用方持有锁）"""
+        if name in self._counts:
+            return
+        self._counts[name] = 0
+        key = name.lower()
+        bisect.insort(self._keys, (key, name))
+        for n in range(1, self.GRAM + 1):
+            for i in range(len(key) - n + 1):
+                self._grams.setdefault(key[i:i + n], set()).add(name)
+
+    def adjust(self, deltas):
+        """按 {标签名: 增量} 更新图片数，未见过的标签自动加入词表"""
+        with self._lock:
+            for name, delta in deltas.items():
+                self._add(name)
+                self._counts[name] = max(0, self._counts[name] + delta)
+
+    def count(self, name):
+        with self._lock:
+            return self._counts.get(name, 0)
+
+    def search(self, keyword, limit=None, prefix=False):
+        """返回包含（prefix=True 时以之开头）keyword 的标签 [(标签名, 图片数)]
+
+        不区分大小写，只返回有图片的标签，按图片数降序。
+        """
+        key = keyword.lower()
+        with self._lock:
+            if prefix:
+                start = bisect.bisect_left(self._keys, (key,))
+                end = bisect.bisect_left(self._keys, (key + '\U0010ffff',), start)
+                names = [name for _, name in self._keys[start:end]]
+            elif len(key) <= self.GRAM:
+                names = self._grams.get(key, ())
+            else:
+                postings = min((self._grams.get(key[i:i + self.GRAM], ())
+                                for i in range(len(key) - self.GRAM + 1)), key=len)
+                names = [name for name in postings if key in name.lower()]
+            result = [(name, self._counts[name]) for name in names if self._counts[name] > 0]
+
+        result.sort(key=lambda item: (-item[1], item[0]))
+        return result[:limit] if limit else result
+
+
+# ── 标签位图索引 ──────────────────────────────────────────
+class TagBitmapIndex:
+    """标签 → 图片 ID 的压缩位图（pyroaring），用于毫秒级计数、AND/OR/NOT 筛选与分面统计
+
+    每个标签有多级位图: 级别 0 为该标签的全部记录，级别 i 为置信度 > buckets[i-1] 的记录，
+    高级别是低级别的子集。键为 (tag_id, 级别)，与 tag_vocab / images 的整数 ID 对应。
+    持久化到 BITMAP_FILE；载入时若与数据库指纹不符（程序外改过数据库或上次未保存就退出）
+    则从 image_tags 重建。增量更新可在处理线程中调用。
+    """
+
+    VERSION = 1
+
+    def __init__(self, path=BITMAP_FILE, buckets=BITMAP_BUCKETS):
+        self.path = path
+        self.buckets = tuple(buckets)
+        self.images = BitMap()
+        self._bitmaps = {}
+        self._lock = threading.Lock()
+        self.dirty = False
+
+    def level(self, op, conf):
+        """查询条件对应的位图级别；不是 "> 分桶阈值" 的条件无法用位图精确表示，返回 None"""
+        if op is None:
+            return 0
+        if op == '>' and conf in self.buckets:
+            return self.buckets.index(conf) + 1
+        return None
+
+    def _levels(self, conf):
+        """置信度 conf 的记录所属的全部级别"""
+        return [0] + [i + 1 for i, threshold in enumerate(self.buckets) if conf is not None and conf > threshold]
+
+    def load(self, cursor):
+        """读入磁盘上的位图；文件缺失、格式不符或已过期时重建"""
+        fingerprint = tuple(cursor.execute(SQL['bitmap_fingerprint']).fetchone())
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+            if (data['version'], tuple(data['buckets']), tuple(data['fingerprint'])) \
+                    == (self.VERSION, self.buckets, fingerprint):
+                with self._lock:
+                    self.images = BitMap.deserialize(data['images'])
+                    self._bitmaps = {key: BitMap.deserialize(blob) for key, blob in data['bitmaps'].items()}
+                    self.dirty = False
+                return
+            print("标签位图索引已过期，正在重建...")
+        except FileNotFoundError:
+            print("未找到标签位图索引，正在建立...")
+        except Exception as e:
+            print(f"标签位图索引读取失败: {e}，正在重建...")
+        self.rebuild(cursor)
+
+    def rebuild(self, cursor):
+        """从 image_tags 全量重建"""
+        start = datetime.now()
+        ids = {}
+        for tag_id, image_id, conf in cursor.execute(SQL['bitmap_rows']):
+            for level in self._levels(conf):
+                ids.setdefault((tag_id, level), []).append(image_id)
+        images = BitMap(image_id for image_id, in cursor.execute(SQL['bitmap_images']))
+
+        with self._lock:
+            self.images = images
+            self._bitmaps = {key: BitMap(values) for key, values in ids.items()}
+            self.dirty = True
+        print(f"标签位图索引已重建: {len(ids)} 个位图，"
+              f"耗时 {(datetime.now() - start).total_seconds():.1f} 秒")
+
+    def save(self, cursor):
+        """写入磁盘（先写临时文件再替换），记录当前数据库指纹"""
+        with self._lock:
+            data = {
+                'version': self.VERSION,
+                'buckets': self.buckets,
+                'fingerprint': tuple(cursor.execute(SQL['bitmap_fingerprint']).fetchone()),
+                'images': self.images.serialize(),
+                'bitmaps': {key: bitmap.serialize() for key, bitmap in self._bitmaps.items()},
+            }
+            self.dirty = False
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def add(self, image_id, tags):
+        """登记一张图片的 [(tag_id, 置信度)]"""
+        with self._lock:
+            self.images.add(image_id)
+            for tag_id, conf in tags:
+                for level in self._levels(conf):
+                    self._bitmaps.setdefault((tag_id, level), BitMap()).add(image_id)
+            self.dirty = True
+
+    def remove(self, image_id, tag_ids=None):
+        """移除一张图片（tag_ids 为 None 时连同图片本身）或它的部分标签"""
+        with self._lock:
+            if tag_ids is None:
+                self.images.discard(image_id)
+                bitmaps = self._bitmaps.values()
+            else:
+                tag_ids = set(tag_ids)
+                bitmaps = [bitmap for (tag_id, _), bitmap in self._bitmaps.items() if tag_id in tag_ids]
+            for bitmap in bitmaps:
+                bitmap.discard(image_id)
+            self.dirty = True
+
+    def select(self, all_of=(), any_of=(), none_of=()):
+        """按 (tag_id, 级别) 求 AND / OR / NOT 组合后的图片 ID 位图
+
+        all_of 从最小的位图开始求交，结果为空时提前结束；any_of 为若干组键，每组取并集后再求交；
+        三者都为空时返回全部图片。
+        """
+        with self._lock:
+            result = None
+            for key in sorted(all_of, key=lambda k: len(self._bitmaps.get(k, ()))):
+                bitmap = self._bitmaps.get(key)
+                if not bitmap:
+                    return BitMap()
+                result = bitmap.copy() if result is None else result & bitmap
+                if not result:
+                    return result
+            for keys in any_of:
+                union = BitMap().union(*[self._bitmaps.get(key, BitMap()) for key in keys])
+                result = union if result is None else result & union
+                if not result:
+                    return result
+            if result is None:
+                result = self.images.copy()
+            for key in none_of:
+                bitmap = self._bitmaps.get(key)
+                if bitmap:
+                    result -= bitmap
+        return result
+
+    def count(self, tag_id, level=0):
+        with self._lock:
+            return len(self._bitmaps.get((tag_id, level), ()))
+
+    def facets(self, selection, level=0, limit=20):
+        """selection 中各标签（指定级别）出现的次数，返回最多 limit 个 [(tag_id, 次数)]，按次数降序"""
+        with self._lock:
+            counts = [(tag_id, selection.intersection_cardinality(bitmap))
+                      for (tag_id, bitmap_level), bitmap in self._bitmaps.items() if bitmap_level == level]
+        counts = [item for item in counts if item[1] > 0]
+        counts.sort(key=lambda item: -item[1])
+        return counts[:limit]
+
+
+# ── 概率向量库 ────────────────────────────────────────────
+class VectorStore:
+    """追加写入的定长向量矩阵文件，按行号以 np.memmap 读取
+
+    文件布局: 64 字节头（魔数、数据类型、向量长度）之后每行一个向量。行号与图片的对应关系
+    由数据库表（如 image_probs）记录，重新处理的图片追加新行、旧行不再引用。
+    float16 原样保存；uint8 把 [0, 1] 的概率按 1/255 量化，体积减半，误差不超过 0.002。
+    """
+
+    MAGIC = b'TAGVEC1\0'
+    HEADER = 64
+    DTYPES = {'float16': np.float16, 'uint8': np.uint8}
+
+    def __init__(self, path, dtype=None, width=None):
+        """打开已有文件（以文件头为准）或按 dtype / width 新建；与给定参数不符时抛出 ValueError"""
+        self.path = path
+        self._lock = threading.Lock()
+        self._map = None
+
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                header = f.read(self.HEADER)
+            if header[:8] != self.MAGIC:
+                raise ValueError(f"不是向量库文件: {path}")
+            meta = json.loads(header[8:].rstrip(b'\0'))
+            if (dtype or meta['dtype'], width or meta['width']) != (meta['dtype'], meta['width']):
+                raise ValueError(f"{path} 为 {meta['dtype']} × {meta['width']}，与当前配置 "
+                                 f"{dtype} × {width} 不符；请改回配置或移走该文件")
+            dtype, width = meta['dtype'], meta['width']
+        elif dtype is None or width is None:
+            raise FileNotFoundError(path)
+        else:
+            meta = json.dumps({'dtype': dtype, 'width': width}).encode()
+            with open(path, 'wb') as f:
+                f.write((self.MAGIC + meta).ljust(self.HEADER, b'\0'))
+
+        self.dtype = dtype
+        self.width = width
+        self._np_dtype = np.dtype(self.DTYPES[dtype])
+        self._row_bytes = self._np_dtype.itemsize * width
+        size = os.path.getsize(path)
+        self.rows = (size - self.HEADER) // self._row_bytes
+        if size > self._end():
+            # 上次写入中途崩溃留下的半行，截掉后新行才能对齐行号
+            with open(path, 'r+b') as f:
+                f.truncate(self._end())
+
+    def _end(self):
+        return self.HEADER + self.rows * self._row_bytes
+
+    def encode(self, matrix):
+        if self.dtype == 'uint8':
+            return np.round(np.clip(matrix, 0, 1) * 255).astype(np.uint8)
+        return np.asarray(matrix, dtype=self._np_dtype)
+
+    def append(self, matrix):
+        """追加 (n, width) 矩阵，返回各行的行号；写入完成后才返回，调用方随后再提交数据库"""
+        data = self.encode(np.atleast_2d(matrix))
+        with self._lock:
+            # 在最后一个完整行之后写入，不用追加模式: 本进程中写入失败留下的残余会被覆盖
+            with open(self.path, 'r+b') as f:
+                f.seek(self._end())
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            start = self.rows
+            self.rows += len(data)
+        return list(range(start, start + len(data)))
+
+    def read(self, rows):
+        """按行号取向量，返回 float32 矩阵"""
+        with self._lock:
+            if self._map is None or self._map.shape[0] < self.rows:
+                self._map = np.memmap(self.path, dtype=self._np_dtype, mode='r',
+                                      offset=self.HEADER, shape=(self.rows, self.width))
+            data = self._map[np.asarray(rows, dtype=np.int64)]
+        if self.dtype == 'uint8':
+            return data.astype(np.float32) / 255
+        return data.astype(np.float32)
+
+
+def l2_normalize(matrix):
+    """按行 L2 归一化，归一化后的点积即余弦相似度"""
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+    return matrix / (np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12)
+
+
+class SimilarityIndex:
+    """图片嵌入向量（已归一化）的最近邻搜索
+
+    默认用分块矩阵乘法对全部向量求余弦相似度（float16 存放、float32 计算）。
+    ivf_lists > 0 且向量足够多时，先用球面 k-means 把向量分成 ivf_lists 个簇（IVF），
+    查询只比较与之最接近的 ivf_probe 个簇中的向量，结果为近似最近邻。
+    """
+
+    CHUNK = 16384
+
+    def __init__(self, ivf_lists=SIMILAR_IVF_LISTS, ivf_probe=SIMILAR_IVF_PROBE):
+        self.ivf_lists = ivf_lists
+        self.ivf_probe = ivf_probe
+        self.ids = np.empty(0, dtype=np.int64)
+        self.matrix = None
+        self._pending = {}          # 载入后新增的 image_id → 向量，查询时并入矩阵
+        self._removed = set()
+        self._centroids = None
+        self._assign = None         # 每行所属的簇
+        self._lock = threading.Lock()
+
+    def load(self, store, entries):
+        """从 VectorStore 读入 [(image_id, 行号)] 对应的向量"""
+        ids = np.array([image_id for image_id, _ in entries], dtype=np.int64)
+        rows = [row for _, row in entries]
+        matrix = np.empty((len(rows), store.width), dtype=np.float16)
+        for start in range(0, len(rows), self.CHUNK):
+            matrix[start:start + self.CHUNK] = store.read(rows[start:start + self.CHUNK])
+
+        with self._lock:
+            self.ids, self.matrix = ids, matrix
+            self._pending, self._removed = {}, set()
+            self._centroids = self._assign = None
+            if self.ivf_lists and len(ids) >= self.ivf_lists * 8:
+                self._train()
+
+    def add(self, image_id, vector):
+        with self._lock:
+            self._pending[image_id] = np.asarray(vector, dtype=np.float16)
+            self._removed.discard(image_id)
+
+    def remove(self, image_id):
+        with self._lock:
+            if self._pending.pop(image_id, None) is None:
+                self._removed.add(image_id)
+
+    def _train(self, iterations=10):
+        """球面 k-means：在抽样上求簇中心，再把全部向量分配到最近的簇（调用方持有锁）"""
+        rng = np.random.default_rng(0)
+        count = min(len(self.ids), self.ivf_lists * 64)
+        sample = self.matrix[rng.choice(len(self.ids), count, replace=False)].astype(np.float32)
+        centroids = sample[rng.choice(count, self.ivf_lists, replace=False)]
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = l2_normalize(sums)
+        self._centroids = centroids
+        self._assign = np.concatenate([np.argmax(self.matrix[start:start + self.CHUNK].astype(np.float32)
+                                                 @ centroids.T, axis=1)
+                                       for start in range(0, len(self.ids), self.CHUNK)])
+
+    def _merge(self):
+        """把新增向量并入矩阵，已训练簇中心时一并分配簇（调用方持有锁）"""
+        if not self._pending:
+            return
+        ids = np.fromiter(self._pending.keys(), dtype=np.int64, count=len(self._pending))
+        vectors = np.stack(list(self._pending.values()))
+        # 重新处理的图片沿用原 ID（UPSERT），先去掉矩阵中这些 ID 的旧向量
+        keep = ~np.isin(self.ids, ids)
+        if not keep.all():
+            self.ids, self.matrix = self.ids[keep], self.matrix[keep]
+            if self._assign is not None:
+                self._assign = self._assign[keep]
+        self.ids = np.concatenate([self.ids, ids])
+        self.matrix = vectors if self.matrix is None else np.concatenate([self.matrix, vectors])
+        if self._centroids is not None:
+            self._assign = np.concatenate([self._assign,
+                                           np.argmax(vectors.astype(np.float32) @ self._centroids.T, axis=1)])
+        self._pending = {}
+
+    def search(self, vector, k):
+        """返回与 vector 最相似的 k 个 [(image_id, 相似度)]，按相似度降序"""
+        vector = l2_normalize(vector)[0]
+        with self._lock:
+            self._merge()
+            ids, matrix, removed = self.ids, self.matrix, list(self._removed)
+            candidates = None
+            if self._centroids is not None:
+                probe = np.argsort(-(self._centroids @ vector))[:self.ivf_probe]
+                candidates = np.nonzero(np.isin(self._assign, probe))[0]
+        if matrix is None or not len(ids):
+            return []
+
+        if candidates is not None:
+            ids, matrix = ids[candidates], matrix[candidates]
+        scores = np.empty(len(ids), dtype=np.float32)
+        for start in range(0, len(ids), self.CHUNK):
+            scores[start:start + self.CHUNK] = matrix[start:start + self.CHUNK].astype(np.float32) @ vector
+        if removed:
+            scores[np.isin(ids, removed)] = -np.inf
+
+        k = min(k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+
+def rethreshold(threshold=PROCESS_THRESHOLD, top_k=TOP_K, db_file=DB_FILE, csv_path=TAGS_CSV_PATH, chunk=512):
+    """按新阈值从概率向量库重建模型标签，不加载模型；收藏等自定义标签保留
+
+    命令行入口: python -m tagify rethreshold [阈值]
+    """
+    if not os.path.exists(PROB_FILE):
+        print(f"未找到概率向量库 {PROB_FILE}：需先设置 probability_store 并重新处理图片，才能按新阈值重建标签")
+        return
+    store = VectorStore(PROB_FILE)
+    tags = pd.read_csv(csv_path)['name'].tolist()
+    if len(tags) != store.width:
+        raise ValueError(f"{csv_path} 有 {len(tags)} 个标签，概率向量长度为 {store.width}")
+
+    conn = connect(db_file)
+    try:
+        cursor = conn.cursor()
+        create_schema(cursor)
+        cursor.executemany(SQL['add_vocab'], ((tag,) for tag in tags))
+        vocab = dict(cursor.execute(SQL['vocab_ids']))
+        model_tag_ids = np.array([vocab[tag] for tag in tags], dtype=np.int64)
+        model_tag_set = set(model_tag_ids.tolist())
+
+        entries = cursor.execute(SQL['prob_rows']).fetchall()
+        print(f"按阈值 {threshold} 重建 {len(entries)} 张图片的标签...")
+        written = 0
+        for start in range(0, len(entries), chunk):
+            image_ids, rows = zip(*entries[start:start + chunk])
+            results = WDTagger.select_tags(store.read(rows), threshold, top_k)
+            for image_id, (indices, scores) in zip(image_ids, results):
+                old = [(image_id, tag_id) for tag_id, in cursor.execute(SQL['image_tag_ids'], (image_id,))
+                       if tag_id in model_tag_set]
+                cursor.executemany(SQL['remove_image_tag'], old)
+                cursor.executemany(SQL['insert_image_tags'],
+                                   [(image_id, tag_id, round(conf, 5))
+                                    for tag_id, conf in zip(model_tag_ids[indices].tolist(), scores.tolist())])
+                written += len(indices)
+            conn.commit()
+            print(f"  {min(start + chunk, len(entries))}/{len(entries)}")
+        print(f"完成，共写入 {written} 条标签记录；没有概率向量的图片保持不变")
+    finally:
+        conn.close()
+
+    # 标签已整体改写，旧位图即使指纹未变（如 top-k 下记录数相同）也不可信，删除后下次启动重建
+    bitmap_file = os.path.splitext(db_file)[0] + ".bitmaps"
+    if os.path.exists(bitmap_file):
+        os.remove(bitmap_file)
+        print(f"已删除过期的标签位图索引 {bitmap_file}，下次启动时重建")
+
+
+# ── 图片解码 ──────────────────────────────────────────────
+
+def open_image(path, target_size=None):
+    """打开图片，FAST_DECODE 开启时对 JPEG 使用缩小解码
+
+    draft() 利用 DCT 缩放按 1/2、1/4、1/8 解码，并自动选择解码结果仍不小于
+    target_size 的最小比例，之后再缩放到目标尺寸时画质不受影响。
+    其他格式无法缩小解码，由后续 resize()/thumbnail() 的 REDUCING_GAP 先做整数倍 reduce()。
+    """
+    img = Image.open(path)
+    if FAST_DECODE and target_size and img.format == 'JPEG':
+        img.draft(None, target_size)
+    return img
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """文件内容的 BLAKE2b 摘要（16 字节），分块读取"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def perceptual_hash(image):
+    """64 位差值哈希 (dHash)：缩成 9×8 灰度图，逐行比较相邻像素明暗
+
+    缩放、重新压缩、轻微调色后仍基本不变。返回有符号整数，可直接存入 SQLite。
+    """
+    pixels = np.asarray(image.convert('L').resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+    value = int(np.packbits(pixels[:, 1:] > pixels[:, :-1]).view('>u8')[0])
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def hamming_distances(hashes, value):
+    """hashes（perceptual_hash() 结果的数组）中每个哈希与 value 相差的位数"""
+    diff = (np.asarray(hashes, dtype=np.int64) ^ np.int64(value)).view(np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(diff)
+    return np.unpackbits(diff.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+def backfill_hashes(db_file=DB_FILE):
+    """为加入去重功能之前入库的图片补算内容哈希与感知哈希
+
+    命令行入口: python -m tagify backfill-hashes
+    """
+    conn = connect(db_file)
+    try:
+        cursor = conn.cursor()
+        create_schema(cursor)
+        entries = cursor.execute(SQL['images_without_hash']).fetchall()
+        print(f"需要补算哈希的图片: {len(entries)} 张")
+        for done, (image_id, name) in enumerate(entries, 1):
+            path = os.path.join(ARCHIVE_FOLDER, name)
+            try:
+                phash = None
+                if PERCEPTUAL_HASH:
+                    with open_image(path, (64, 64)) as img:
+                        phash = perceptual_hash(img)
+                cursor.execute(SQL['set_image_hashes'], (file_hash(path), phash, image_id))
+            except Exception as e:
+                print(f"  跳过 {name}: {e}")
+            if done % 500 == 0:
+                conn.commit()
+                print(f"  {done}/{len(entries)}")
+        conn.commit()
+        print("完成")
+    finally:
+        conn.close()
+
+
+# ── 模型封装 ──────────────────────────────────────────────
+class WDTagger:
+    """WD ViT Tagger v3 模型封装类"""
+
+    def __init__(self, model_path=MODEL_PATH, config_path=CONFIG_PATH, csv_path=TAGS_CSV_PATH):
+        print("正在初始化新模型...")
+
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        print(f"使用设备: {self.device}")
+
+        with open(config_path, 'r', encoding='utf-8') as f:
+            self.config = json.load(f)
+
+        self.model = timm.create_model(
+            self.config['architecture'],
+            pretrained=False,
+            num_classes=self.config['num_classes'],
+            **self.config['model_args']
+        )
+
+        state_dict = load_file(model_path)
+        self.model.load_state_dict(state_dict)
+        self.model = self.model.to(self.device)
+        self.model.eval()
+
+        self.df = pd.read_csv(csv_path)
+        self.tags = self.df['name'].tolist()
+
+        print(f"模型加载成功！标签数量: {len(self.tags)}")
+
+    def to_tensor(self, image):
+        """图片 → 归一化后的 CHW 张量（留在 CPU 上，可在解码线程中调用）"""
+        image = image.resize(IMAGE_SIZE, Image.Resampling.BICUBIC, reducing_gap=REDUCING_GAP)
+        img_array = np.array(image).astype(np.float32) / 255.0
+
+        mean = np.array([0.5, 0.5, 0.5], dtype=np.float32)
+        std = np.array([0.5, 0.5, 0.5], dtype=np.float32)
+        img_array = (img_array - mean) / std
+
+        return torch.from_numpy(img_array).permute(2, 0, 1)
+
+    def preprocess(self, image):
+        """预处理图片"""
+        img_tensor = self.to_tensor(image).unsqueeze(0)
+        return img_tensor.to(self.device)
+
+    def predict(self, image, threshold=DEFAULT_THRESHOLD):
+        """预测图片标签"""
+        return self.predict_batch([image], threshold)[0]
+
+    def predict_batch(self, images, threshold=DEFAULT_THRESHOLD):
+        """批量预测：一次前向传播处理多张图片，返回与输入顺序一一对应的标签列表"""
+        if not images:
+            return []
+        return self.predict_tensors([self.to_tensor(image) for image in images], threshold)
+
+    def predict_tensors(self, tensors, threshold=DEFAULT_THRESHOLD):
+        """对已预处理的 CHW 张量列表做一次前向传播"""
+        return [self.tag_names(indices, scores)
+                for indices, scores in self.select_tags(self.infer(tensors), threshold)]
+
+    def infer(self, tensors, embeddings=False):
+        """前向传播，返回 (batch, num_tags) 的 sigmoid 概率矩阵
+
+        embeddings=True 时同时返回分类头之前的池化特征 (batch, num_features)，已 L2 归一化。
+        """
+        input_tensor = torch.stack(tensors).to(self.device)
+
+        with torch.no_grad():
+            if not embeddings:
+                outputs = self.model(input_tensor)
+                return torch.sigmoid(outputs).cpu().numpy()
+
+            features = self.model.forward_features(input_tensor)
+            pooled = self.model.forward_head(features, pre_logits=True)
+            outputs = self.model.forward_head(features)
+            return torch.sigmoid(outputs).cpu().numpy(), l2_normalize(pooled.float().cpu().numpy())
+
+    @staticmethod
+    def select_tags(probs, threshold, top_k=TOP_K):
+        """向量化提取每行中置信度 > threshold 的标签
+
+        一次处理整个 (batch, num_tags) 概率矩阵；top_k > 0 时先用 argpartition
+        截取每行概率最高的 top_k 个。返回每行一个 (标签索引数组, 置信度数组)，
+        索引按升序排列，需要标签名时再用 tag_names() 映射。
+        """
+        probs = np.atleast_2d(probs)
+        if top_k and top_k < probs.shape[1]:
+            cols = np.argpartition(probs, -top_k, axis=1)[:, -top_k:]
+            cols.sort(axis=1)
+            top = np.take_along_axis(probs, cols, axis=1)
+            rows, pos = np.nonzero(top > threshold)
+            cols, scores = cols[rows, pos], top[rows, pos]
+        else:
+            rows, cols = np.nonzero(probs > threshold)
+            scores = probs[rows, cols]
+
+        bounds = np.searchsorted(rows, np.arange(1, probs.shape[0]))
+        return list(zip(np.split(cols, bounds), np.split(scores, bounds)))
+
+    def tag_names(self, indices, scores):
+        """把 select_tags() 的索引/置信度数组映射为 [(标签, 置信度)]"""
+        return [(self.tags[i], float(conf)) for i, conf in zip(indices.tolist(), scores.tolist())]
+
+
+class PreprocessPipeline:
+    """解码/预处理流水线
+
+    多个工作线程预先执行 loader（读图、缩放、归一化），结果放入有界队列；
+    推理循环迭代本对象即可按完成顺序取得 (item, 结果, 异常)。
+    stop_event 置位或迭代提前结束时，工作线程会在下一次检查时退出。
+    """
+
+    _DONE = object()
+
+    def __init__(self, loader, items, workers=DECODE_WORKERS, depth=PREFETCH_DEPTH, stop_event=None):
+        self.loader = loader
+        self._tasks = queue.Queue()
+        for item in items:
+            self._tasks.put(item)
+        self._ready = queue.Queue(maxsize=max(1, depth))
+        self._stop_event = stop_event or threading.Event()
+        self._closed = threading.Event()
+        self._threads = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(max(1, workers))]
+
+    def _stopped(self):
+        return self._stop_event.is_set() or self._closed.is_set()
+
+    def _put(self, entry):
+        """放入就绪队列；队列满时定期醒来检查停止信号，避免消费者退出后永久阻塞"""
+        while not self._stopped():
+            try:
+                self._ready.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _work(self):
+        while not self._stopped():
+            try:
+                item = self._tasks.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                entry = (item, self.loader(item), None)
+            except Exception as e:
+                entry = (item, None, e)
+            if not self._put(entry):
+                return
+        self._put(self._DONE)
+
+    def __iter__(self):
+        for t in self._threads:
+            t.start()
+        finished = 0
+        try:
+            while finished < len(self._threads) and not self._stop_event.is_set():
+                try:
+                    entry = self._ready.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if entry is self._DONE:
+                    finished += 1
+                else:
+                    yield entry
+        finally:
+            self.close()
+
+    def close(self):
+        """通知工作线程退出并等待其结束"""
+        self._closed.set()
+        for t in self._threads:
+            if t.is_alive():
+                t.join()
+
+
+# ── 缩略图磁盘缓存 ────────────────────────────────────────
+
+class ThumbnailStore:
+    """持久化缩略图缓存（独立 SQLite 文件中的 BLOB 表）
+
+    每个文件名保存一张编码后的缩略图，并记录原图 mtime、文件大小与生成时的 THUMB_SIZE；
+    原图被替换或缩略图尺寸配置改变后键不再匹配，视为未命中并在下次写入时覆盖。
+    内部连接加锁，可同时被界面线程与处理线程使用。
+    """
+
+    def __init__(self, path=THUMB_DB_FILE, size=THUMB_SIZE, fmt=THUMB_STORE_FMT):
+        self.size = size
+        self.fmt = fmt.upper()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS thumbnails
+                              (
+                                  name      TEXT PRIMARY KEY,
+                                  mtime     INTEGER,
+                                  file_size INTEGER,
+                                  width     INTEGER,
+                                  height    INTEGER,
+                                  data      BLOB
+                              )''')
+        self._conn.commit()
+
+    @staticmethod
+    def _file_key(path):
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    def encode(self, image):
+        """把已缩小到 THUMB_SIZE 以内的图片编码为存储格式"""
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        mode = 'RGBA' if has_alpha and self.fmt != 'JPEG' else 'RGB'
+        if image.mode != mode:
+            image = image.convert(mode)
+        output = BytesIO()
+        image.save(output, self.fmt, quality=85)
+        return output.getvalue()
+
+    def get(self, name, path):
+        """命中返回已解码的缩略图（PIL Image），未命中或原图不存在返回 None"""
+        try:
+            mtime, file_size = self._file_key(path)
+        except OSError:
+            return None
+
+        with self._lock:
+            row = self._conn.execute('''SELECT data
+                                         FROM thumbnails
+                                         WHERE name = ?
+                                           AND mtime = ?
+                                           AND file_size = ?
+                                           AND width = ?
+                                           AND height = ?''',
+                                      (name, mtime, file_size, *self.size)).fetchone()
+        if row is None:
+            return None
+
+        img = Image.open(BytesIO(row[0]))
+        img.load()
+        return img
+
+    def put(self, name, path, image=None, data=None, commit=True):
+        """写入缩略图：传入已缩小的 image，或已编码的 data；键取自 path 当前的 mtime/大小"""
+        if data is None:
+            data = self.encode(image)
+        mtime, file_size = self._file_key(path)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?)",
+                               (name, mtime, file_size, *self.size, data))
+            if commit:
+                self._conn.commit()
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def delete(self, name):
+        with self._lock:
+            self._conn.execute("DELETE FROM thumbnails WHERE name = ?", (name,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+# ── 入库引擎 ──────────────────────────────────────────────
+
+def migrate_legacy_tables(cursor):
+    """旧版 tags / image_metadata 表原地迁移到新结构（同一事务内完成，失败自动回滚）"""
+    tables = {name for name, in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if not {'tags', 'image_metadata'} & tables:
+        return
+
+    print("检测到旧版数据库结构，正在迁移...")
+    if 'image_metadata' in tables:
+        cursor.execute('''INSERT OR IGNORE INTO images (name, file_size, process_time)
+                          SELECT image_name, file_size, process_time
+                          FROM image_metadata''')
+    if 'tags' in tables:
+        cursor.execute('''INSERT OR IGNORE INTO tag_vocab (name)
+                          SELECT DISTINCT tag
+                          FROM tags''')
+        # 没有元数据的标签记录在旧版中本就不会显示，迁移时一并丢弃
+        cursor.execute('''INSERT OR REPLACE INTO image_tags (image_id, tag_id, confidence)
+                          SELECT i.id, v.id, t.confidence
+                          FROM tags t
+                              JOIN images i ON i.name = t.image_name
+                              JOIN tag_vocab v ON v.name = t.tag''')
+        print(f"已迁移 {cursor.rowcount} 条标签记录")
+        cursor.execute("DROP TABLE tags")
+    if 'image_metadata' in tables:
+        cursor.execute("DROP TABLE image_metadata")
+
+
+def prepare_database(cursor):
+    """建表建索引 / 迁移旧版结构 / 升级前的数据库补齐 tag_stats（可重复执行）
+
+    images      每张图片一行，name 唯一
+    tag_vocab   标签字典，标签名只存一次
+    image_tags  (image_id, tag_id, confidence)，整数外键代替重复的 TEXT
+    tag_stats   每个标签的图片数与置信度汇总，由触发器维护
+    """
+    has_stats = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'tag_stats'").fetchone()
+    create_schema(cursor)
+
+    migrate_legacy_tables(cursor)
+    if not has_stats:
+        # 升级前的数据库: 触发器只统计之后的写入，先按现有数据补齐
+        print(f"已初始化 tag_stats: {rebuild_tag_stats(cursor)} 个标签")
+
+
+def open_embed_store(width=None):
+    """打开嵌入向量库；未开启 save_embeddings、不可用或（width 为 None 时）文件不存在返回 None"""
+    if not SAVE_EMBEDDINGS:
+        return None
+    try:
+        return VectorStore(EMBED_FILE, 'float16', width)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        print(f"嵌入向量库不可用: {e}")
+        return None
+
+
+def unique_filename(filename, folder=ARCHIVE_FOLDER, taken=()):
+    """folder 中不与现有文件（及 taken 中已预留的文件名）重名的文件名: 未被占用时原样返回，否则追加 _1、_2 ..."""
+    if filename not in taken and not os.path.exists(os.path.join(folder, filename)):
+        return filename
+    base_name, ext = os.path.splitext(filename)
+    counter = 1
+    while True:
+        new_filename = f"{base_name}_{counter}{ext}"
+        new_dest_path = os.path.join(folder, new_filename)
+        if new_filename not in taken and not os.path.exists(new_dest_path):
+            return new_filename
+        counter += 1
+
+
+def finish_interrupted_moves(conn, on_error=print):
+    """把已写库、尚未移入归档目录的图片（入库日志 committed）移过去，返回归档的文件名
+
+    两边都有文件说明跨磁盘移动时中断，归档目录中的可能不完整，以源文件为准重新移动；
+    源文件已被换成别的内容时不再移动。两边都没有文件的记录留给 repair_archive() 删除。
+    """
+    moved, done = [], []
+    for src_path, dest_name, content_hash in conn.execute(SQL['journal_committed']).fetchall():
+        dest_path = os.path.join(ARCHIVE_FOLDER, dest_name)
+        try:
+            if os.path.exists(src_path) and content_hash in (None, file_hash(src_path)):
+                if os.path.exists(dest_path):
+                    os.remove(dest_path)
+                shutil.move(src_path, dest_path)
+                moved.append(dest_name)
+            elif not os.path.exists(dest_path):
+                on_error(f"入库中断的图片已不存在: {src_path}")
+        except OSError as e:
+            on_error(f"归档失败: {dest_name}\n{str(e)}")
+            continue
+        done.append(src_path)
+    now = datetime.now().isoformat()
+    conn.executemany(SQL['journal_moved'], ((now, src_path) for src_path in done))
+    conn.commit()
+    return moved
+
+
+def repair_archive(conn, input_folder=INPUT_FOLDER):
+    """修复入库中断等原因留下的不一致，返回 {'moved', 'removed', 'returned'}
+
+    1. 已写库未归档的图片补做归档（moved: 文件名）；
+    2. 归档目录中缺少文件的记录连同标签与向量行号一起删除（removed: [(image_id, 文件名)]）；
+    3. 归档目录中没有记录的图片移回输入目录，下次处理时重新入库（returned: 移回后的文件名）。
+    处理图片期间不要调用: 正在入库的图片在写库与归档之间会被当成缺少文件的记录。
+    """
+    moved = finish_interrupted_moves(conn)
+
+    cursor = conn.cursor()
+    records = {name: image_id for image_id, name in cursor.execute(SQL['all_images'])}
+    files = set(os.listdir(ARCHIVE_FOLDER))
+    removed = [(image_id, name) for name, image_id in records.items() if name not in files]
+    try:
+        for image_id, _ in removed:
+            cursor.execute(SQL['clear_image_tags'], (image_id,))
+            cursor.execute(SQL['delete_image_prob_id'], (image_id,))
+            cursor.execute(SQL['delete_image_embedding_id'], (image_id,))
+            cursor.execute(SQL['delete_image_id'], (image_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    returned = []
+    os.makedirs(input_folder, exist_ok=True)
+    for filename in sorted(files - records.keys()):
+        src_path = os.path.join(ARCHIVE_FOLDER, filename)
+        if not filename.lower().endswith(VALID_EXTENSIONS) or not os.path.isfile(src_path):
+            continue
+        target = unique_filename(filename, input_folder)
+        shutil.move(src_path, os.path.join(input_folder, target))
+        returned.append(target)
+    return {'moved': moved, 'removed': removed, 'returned': returned}
+
+
+def repair_command(input_folder=INPUT_FOLDER, db_file=DB_FILE):
+    """命令行入口: python -m tagify repair（不要与入库同时运行）"""
+    conn = connect(db_file)
+    try:
+        create_schema(conn.cursor())
+        result = repair_archive(conn, input_folder)
+    finally:
+        conn.close()
+    print(f"补做归档: {len(result['moved'])} 张")
+    print(f"删除缺少文件的记录: {len(result['removed'])} 条")
+    print(f"移回 {input_folder} 重新入库: {len(result['returned'])} 张")
+
+
+class FolderWatcher:
+    """监视输入目录，交出已写完的图片文件名
+
+    文件大小与 mtime 连续 settle 秒不变才视为写完；已交出且之后没有改动的文件不再交出
+    （处理失败留在目录中的文件，被修改或替换后会再次交出）。装有 watchdog 时新文件出现
+    即唤醒扫描，否则每 poll 秒扫描一次目录。
+    """
+
+    def __init__(self, folder, settle=WATCH_SETTLE, poll=WATCH_POLL):
+        self.folder = folder
+        self.settle = settle
+        self.poll = poll
+        self._pending = {}      # 文件名 → (大小, mtime, 首次见到该状态的时间)
+        self._yielded = {}      # 文件名 → 交出时的 (大小, mtime)
+        self._wakeup = threading.Event()
+        self._observer = None
+
+    def start(self):
+        if Observer is not None:
+            try:
+                handler = FileSystemEventHandler()
+                handler.on_any_event = lambda event: self._wakeup.set()
+                self._observer = Observer()
+                self._observer.schedule(handler, self.folder, recursive=False)
+                self._observer.start()
+            except Exception as e:
+                print(f"文件事件监视不可用，改为定时扫描: {e}")
+                self._observer = None
+        return self
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def delay(self):
+        """距下一次需要扫描的秒数: 有文件等待稳定时为其中最早一个满 settle 秒的时刻，否则为 poll"""
+        if not self._pending:
+            return self.poll
+        now = time.monotonic()
+        return max(0.05, min(self.poll, min(since + self.settle - now for _, _, since in self._pending.values())))
+
+    def wait(self, timeout):
+        """最多等待 timeout 秒（文件事件会提前唤醒），然后扫描目录，返回新近写完的文件名"""
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+        return self.scan()
+
+    def scan(self):
+        """扫描一次目录，返回新近写完的图片文件名"""
+        now = time.monotonic()
+        ready = []
+        present = set()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(VALID_EXTENSIONS):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+
+                name = entry.name
+                state = (st.st_size, st.st_mtime_ns)
+                present.add(name)
+                if self._yielded.get(name) == state:
+                    continue
+                pending = self._pending.get(name)
+                if pending is None or pending[:2] != state:
+                    self._pending[name] = (*state, now)
+                elif now - pending[2] >= self.settle:
+                    del self._pending[name]
+                    self._yielded[name] = state
+                    ready.append(name)
+
+        # 已被移走的文件不再跟踪
+        for table in (self._pending, self._yielded):
+            for name in [name for name in table if name not in present]:
+                del table[name]
+        return ready
+
+
+# 已推理、等待写库的图片: tags 为 [(tag_id, 标签名, 置信度)]，prob_row 为概率向量在 prob_store 中的行号，
+# embed_row 为 (embed_store 行号, 嵌入向量)，thumb 为已编码的缩略图（None 时留到浏览时再生成）
+StagedImage = namedtuple('StagedImage', 'filename src_path tags thumb prob_row embed_row content_hash phash')
+# 已在事务中写入的图片: name 为归档后的文件名，replaced 表示覆盖了同名旧记录（沿用其 image_id）
+StoredImage = namedtuple('StoredImage', 'item name dest_path image_id replaced tag_deltas tag_rows')
+
+
+class IngestEngine:
+    """图片入库流程: 解码线程池预处理 → 每 BATCH_SIZE 张批量推理 → 写库 → 移入归档目录
+
+    不依赖界面，GUI（main.py）与命令行（python -m tagify ingest）共用。通过回调报告进度:
+        on_progress(已完成张数, 总张数, 消息)    每张图片入库或按重复处理后
+        on_error(消息)                          单张或整批失败时，流程继续处理其余图片
+        on_batch()                              每批写库后（界面据此清空分页缓存）
+    tag_index / tag_bitmaps / similarity_index 为调用方持有的内存索引，设置后随写库同步更新。
+    """
+
+    def __init__(self, tagger, thumb_store, db=None, workers=DECODE_WORKERS, stop_event=None,
+                 on_progress=None, on_error=None, on_batch=None):
+        self.tagger = tagger
+        self.thumb_store = thumb_store
+        self.db = db or ConnectionManager()
+        self.workers = workers
+        self.stop_event = stop_event or threading.Event()
+        self.on_progress = on_progress or (lambda done, total, message: None)
+        self.on_error = on_error or print
+        self.on_batch = on_batch or (lambda: None)
+
+        self.tag_index = None
+        self.tag_bitmaps = None
+        self.similarity_index = None
+
+        # 完整概率向量库与嵌入向量库（可选），按模型的标签数 / 特征维度打开
+        self.prob_store = None
+        if PROB_STORE != "off":
+            try:
+                self.prob_store = VectorStore(PROB_FILE, PROB_STORE, len(tagger.tags))
+            except ValueError as e:
+                print(f"概率向量库不可用: {e}")
+        self.embed_store = open_embed_store(tagger.model.num_features)
+
+        # 已推理、等待写库的图片（见 _flush()）
+        self._staged = []
+
+        # 模型标签索引 → tag_vocab.id，由 prepare() 填充，写库时直接用整数 ID
+        self.model_tag_ids = None
+
+        # 去重状态（处理整个目录时从数据库载入，随入库增量更新）
+        self.duplicate_folder = None
+        self._dedupe_loaded = False
+        self._known_hashes = {}
+        self._phash_names = []
+        self._phash_values = np.empty(0, dtype=np.int64)   # 预留容量，前 len(_phash_names) 项有效
+        self._near_duplicates = []
+
+    def prepare(self, cursor):
+        """把模型标签表写入 tag_vocab 并取得各标签的 ID"""
+        cursor.executemany(SQL['add_vocab'], ((tag,) for tag in self.tagger.tags))
+        vocab = dict(cursor.execute(SQL['vocab_ids']))
+        self.model_tag_ids = np.array([vocab[tag] for tag in self.tagger.tags], dtype=np.int64)
+
+    def run(self, input_folder=INPUT_FOLDER, image_files=None):
+        """处理 input_folder 中的图片（image_files 为其中部分文件名，默认全部），返回统计
+
+        {'total', 'done', 'renamed', 'overwritten', 'duplicates', 'near_duplicates', 'cancelled'}，
+        near_duplicates 为 [(新图片名, 已有图片名, 相差位数)]。stop_event 置位后尽快返回，
+        未推理的半批直接丢弃，文件保留在输入目录。上次中断时已推理的图片先续做（计入 total）。
+        """
+        reload = image_files is None or not self._dedupe_loaded
+        if image_files is None:
+            image_files = [f for f in os.listdir(input_folder) if f.lower().endswith(VALID_EXTENSIONS)]
+
+        # #6 修复: 共用一条数据库连接（ConnectionManager 的写连接，跨多次处理复用）
+        conn = self.db.writer
+        try:
+            cursor = conn.cursor()
+            if self.model_tag_ids is None:
+                prepare_database(cursor)
+                self.prepare(cursor)
+                conn.commit()
+
+            # 续做的图片不再走解码与推理；补做归档后已不在输入目录的文件同样跳过
+            resumed = self._resume(conn)
+            resumed_paths = {item.src_path for item in resumed}
+            image_files = [f for f in image_files
+                           if os.path.abspath(os.path.join(input_folder, f)) not in resumed_paths
+                           and os.path.exists(os.path.join(input_folder, f))]
+            total = len(image_files) + len(resumed)
+            stats = {'total': total, 'done': 0, 'renamed': 0, 'overwritten': 0, 'duplicates': 0,
+                     'near_duplicates': [], 'cancelled': False}
+
+            # 去重: 解码线程据此跳过已入库的图片；近似重复用感知哈希逐张比较
+            self.duplicate_folder = os.path.join(input_folder, "duplicates")
+            if reload:
+                self._known_hashes = dict(conn.execute(SQL['content_hashes']))
+                phashes = conn.execute(SQL['perceptual_hashes']).fetchall()
+                self._phash_names = [name for name, _ in phashes]
+                self._phash_values = np.array([value for _, value in phashes], dtype=np.int64)
+                self._dedupe_loaded = True
+            self._near_duplicates = stats['near_duplicates']
+            for item in resumed:
+                self._stage(conn, total, stats, item)
+
+            pipeline = PreprocessPipeline(
+                self._load_for_inference,
+                [(filename, os.path.join(input_folder, filename)) for filename in image_files],
+                workers=self.workers, stop_event=self.stop_event)
+
+            batch = []      # [(文件名, 源路径, (预处理张量, 缩略图数据, 内容哈希, 感知哈希))]
+            waiting = []    # 与当前批次中某张图片内容相同，等那张入库后再按重复处理
+            for (filename, src_path), loaded, error in pipeline:
+                if error is not None:
+                    self.on_error(f"处理失败: {filename}\n{str(error)}")
+                    continue
+
+                if any(loaded[2] == item[2][2] for item in batch):
+                    waiting.append((filename, src_path, loaded))
+                    continue
+                item = self._admit(conn, filename, src_path, loaded, total, stats)
+                if item is not None:
+                    batch.append(item)
+                if len(batch) >= BATCH_SIZE:
+                    self._process_batch(conn, batch, total, stats)
+                    batch, waiting = self._admit_waiting(conn, waiting, total, stats)
+
+            # #10 修复: 检查停止信号
+            if self.stop_event.is_set():
+                stats['cancelled'] = True
+            else:
+                while batch:
+                    self._process_batch(conn, batch, total, stats)
+                    batch, waiting = self._admit_waiting(conn, waiting, total, stats)
+            # 已推理的图片即使中途停止也写库归档
+            self._flush(conn, total, stats)
+
+            if self.tag_bitmaps is not None and self.tag_bitmaps.dirty:
+                try:
+                    self.tag_bitmaps.save(cursor)
+                except Exception as e:
+                    print(f"标签位图索引保存失败: {e}")
+        finally:
+            # 出错中断时撤销未提交的写入，连接留给下一次处理
+            if conn.in_transaction:
+                conn.rollback()
+        return stats
+
+    def watch(self, input_folder=INPUT_FOLDER, batch_delay=WATCH_BATCH_DELAY, on_run=None):
+        """持续监视 input_folder 直到 stop_event 置位，新图片写完后自动入库
+
+        写完的图片攒够 BATCH_SIZE 张、或其中最早一张已等待 batch_delay 秒时交给 run()，
+        模型常驻内存；每次 run() 结束后调用 on_run(统计)。启动时目录中已有的图片同样会被处理。
+        """
+        pending = []
+        deadline = None
+        with FolderWatcher(input_folder) as watcher:
+            while not self.stop_event.is_set():
+                timeout = watcher.delay()
+                if deadline is not None:
+                    timeout = min(timeout, max(0.0, deadline - time.monotonic()))
+                ready = watcher.wait(timeout)
+                if ready and deadline is None:
+                    deadline = time.monotonic() + batch_delay
+                pending += ready
+
+                if pending and (len(pending) >= BATCH_SIZE or time.monotonic() >= deadline):
+                    stats = self.run(input_folder, pending)
+                    pending, deadline = [], None
+                    if on_run is not None:
+                        on_run(stats)
+
+    def summary(self, stats):
+        """run() 统计的文字说明"""
+        message = f"处理完成! 共 {stats['total']} 张图片"
+        if stats['renamed'] > 0:
+            message += f", {stats['renamed']} 张因重名被重命名"
+        if stats['overwritten'] > 0:
+            message += f", {stats['overwritten']} 张覆盖了旧记录"
+        if stats['duplicates'] > 0:
+            action = "已复用原有标签入库" if DUPLICATE_ACTION == "copy" else f"已移到 {self.duplicate_folder}"
+            message += f", {stats['duplicates']} 张与已有图片内容相同（未推理，{action}）"
+        return message
+
+    def _resume(self, conn):
+        """续做上次中断的入库: 已写库的图片补做归档，已推理的图片返回 StagedImage 直接写库，不再推理
+
+        源文件已不存在或内容已变的日志行丢弃，这些图片按新文件重新处理；缩略图留到浏览时生成。
+        """
+        finish_interrupted_moves(conn, self.on_error)
+        conn.execute(SQL['journal_prune'])
+        resumed, dropped = [], []
+        for src_path, content_hash, phash, tags, prob_row, embed_row in \
+                conn.execute(SQL['journal_inferred']).fetchall():
+            try:
+                valid = file_hash(src_path) == content_hash
+            except OSError:
+                valid = False
+            if not valid:
+                dropped.append((src_path,))
+                continue
+            if self.prob_store is None:
+                prob_row = None
+            try:
+                embed_row = None if embed_row is None or self.embed_store is None \
+                    else (embed_row, self.embed_store.read([embed_row])[0])
+            except Exception:
+                embed_row = None
+            resumed.append(StagedImage(os.path.basename(src_path), src_path, [tuple(tag) for tag in json.loads(tags)],
+                                       None, prob_row, embed_row, content_hash, phash))
+        conn.executemany(SQL['journal_delete'], dropped)
+        conn.commit()
+        if resumed:
+            print(f"续做上次中断的入库: {len(resumed)} 张已推理的图片")
+        return resumed
+
+    def _load_for_inference(self, item):
+        """解码线程: 先算内容哈希，已入库过的图片不再解码；否则预处理为张量并生成缩略图"""
+        _, src_path = item
+        content_hash = file_hash(src_path)
+        if content_hash in self._known_hashes:
+            return None, None, content_hash, None
+        return self._decode_for_inference(src_path, content_hash)
+
+    def _decode_for_inference(self, src_path, content_hash):
+        """读图并预处理为张量，顺便用已解码的图生成缩略图与感知哈希"""
+        with open_image(src_path, IMAGE_SIZE) as img:
+            rgb = img.convert('RGB')
+            phash = perceptual_hash(rgb) if PERCEPTUAL_HASH else None
+            tensor = self.tagger.to_tensor(rgb)
+            # 缩略图只是缓存: 编码失败（如 Pillow 不支持 WebP）不影响入库，留到浏览时再生成
+            try:
+                img.thumbnail(THUMB_SIZE, reducing_gap=REDUCING_GAP)
+                thumb = self.thumb_store.encode(img)
+            except Exception as e:
+                print(f"缩略图生成错误: {os.path.basename(src_path)} - {str(e)}")
+                thumb = None
+            return tensor, thumb, content_hash, phash
+
+    def _admit(self, conn, filename, src_path, loaded, total, stats):
+        """按重复处理掉的图片返回 None，否则返回待推理的 (文件名, 源路径, loaded)"""
+        if self._ingest_duplicate(conn, filename, src_path, loaded, total, stats):
+            return None
+        if loaded[0] is None:
+            # 解码线程按旧的哈希表跳过了解码，但那条记录已被覆盖或删除
+            try:
+                loaded = self._decode_for_inference(src_path, loaded[2])
+            except Exception as e:
+                self.on_error(f"处理失败: {filename}\n{str(e)}")
+                return None
+        return filename, src_path, loaded
+
+    def _admit_waiting(self, conn, waiting, total, stats):
+        """上一批入库后重新处理等待中的图片，返回 (新批次, 仍需等待的图片)"""
+        if waiting:
+            # 等待的图片要与刚推理的图片比对内容哈希，先把暂存的写入数据库
+            self._flush(conn, total, stats)
+        batch, still_waiting = [], []
+        for filename, src_path, loaded in waiting:
+            if any(loaded[2] == item[2][2] for item in batch):
+                still_waiting.append((filename, src_path, loaded))
+                continue
+            item = self._admit(conn, filename, src_path, loaded, total, stats)
+            if item is not None:
+                batch.append(item)
+        return batch, still_waiting
+
+    def _ingest_duplicate(self, conn, filename, src_path, loaded, total, stats):
+        """内容与已入库图片完全相同时不做推理，按 DUPLICATE_ACTION 处理；返回是否按重复处理了
+
+        skip: 移到输入目录的 duplicates 子目录；copy: 复用原图的标签与向量，暂存后与其他图片一起入库。
+        """
+        if any(item.content_hash == loaded[2] for item in self._staged):
+            # 与本次已推理、尚未写库的图片内容相同: 先把暂存的写入数据库，再按重复处理
+            self._flush(conn, total, stats)
+        existing = conn.execute(SQL['image_by_hash'], (loaded[2],)).fetchone()
+        if existing is None:
+            return False
+
+        existing_id, existing_name = existing
+        try:
+            if DUPLICATE_ACTION == "copy":
+                cursor = conn.cursor()
+                tags = cursor.execute(SQL['image_tag_rows'], (existing_id,)).fetchall()
+                prob = cursor.execute(SQL['image_prob_row'], (existing_id,)).fetchone()
+                embed = cursor.execute(SQL['image_embedding_row'], (existing_id,)).fetchone()
+                embed_row = None
+                if embed and self.embed_store is not None:
+                    embed_row = (embed[0], self.embed_store.read([embed[0]])[0])
+                self._stage(conn, total, stats, StagedImage(filename, src_path, tags, loaded[1],
+                                                            prob[0] if prob else None, embed_row, *loaded[2:]))
+            else:
+                os.makedirs(self.duplicate_folder, exist_ok=True)
+                shutil.move(src_path, os.path.join(self.duplicate_folder,
+                                                   unique_filename(filename, self.duplicate_folder)))
+                stats['done'] += 1
+                self.on_progress(stats['done'], total, f"重复: {filename} = {existing_name}")
+            stats['duplicates'] += 1
+        except Exception as e:
+            self.on_error(f"处理失败: {filename}\n{str(e)}")
+        return True
+
+    def _check_near_duplicate(self, image_name, phash):
+        """与已入库图片的感知哈希比较，相差不超过 NEAR_DUP_DISTANCE 位的记为近似重复"""
+        if phash is None:
+            return
+        count = len(self._phash_names)
+        if count:
+            distances = hamming_distances(self._phash_values[:count], phash)
+            for i in np.nonzero(distances <= NEAR_DUP_DISTANCE)[0].tolist():
+                self._near_duplicates.append((image_name, self._phash_names[i], int(distances[i])))
+        if count == len(self._phash_values):
+            # 容量用尽时翻倍扩充，避免每张图片都用 np.append 复制整个数组
+            grown = np.empty(max(count * 2, 256), dtype=np.int64)
+            grown[:count] = self._phash_values[:count]
+            self._phash_values = grown
+        self._phash_values[count] = phash
+        self._phash_names.append(image_name)
+
+    def _process_batch(self, conn, batch, total, stats):
+        """一次前向传播推理整批图片，再逐张写库并归档
+
+        推理前后各在入库日志中记一笔（queued / inferred），推理结果随之落盘，中断后不必重新推理。
+        """
+        src_paths = [os.path.abspath(src_path) for _, src_path, _ in batch]
+        now = datetime.now().isoformat()
+        conn.executemany(SQL['journal_queue'], ((src_path, *loaded[2:], now)
+                                                for src_path, (_, _, loaded) in zip(src_paths, batch)))
+        conn.commit()
+        try:
+            tensors = [loaded[0] for _, _, loaded in batch]
+            if self.embed_store is not None:
+                probs, embeddings = self.tagger.infer(tensors, embeddings=True)
+            else:
+                probs, embeddings = self.tagger.infer(tensors), None
+            results = self.tagger.select_tags(probs, PROCESS_THRESHOLD)
+        except Exception as e:
+            names = ", ".join(filename for filename, _, _ in batch)
+            self.on_error(f"批量推理失败: {names}\n{str(e)}")
+            return
+
+        # 先把整批概率向量写入文件，各图片写库时再记录行号（中途失败只会留下未引用的行）
+        prob_rows = embed_rows = [None] * len(batch)
+        if self.prob_store is not None:
+            try:
+                prob_rows = self.prob_store.append(probs)
+            except Exception as e:
+                self.on_error(f"概率向量写入失败: {str(e)}")
+        if embeddings is not None:
+            try:
+                embed_rows = list(zip(self.embed_store.append(embeddings), embeddings))
+            except Exception as e:
+                self.on_error(f"嵌入向量写入失败: {str(e)}")
+
+        staged = []
+        for (filename, src_path, (_, thumb, *hashes)), (indices, scores), prob_row, embed_row in zip(
+                batch, results, prob_rows, embed_rows):
+            tags = list(zip(self.model_tag_ids[indices].tolist(),
+                            [self.tagger.tags[i] for i in indices.tolist()],
+                            scores.tolist()))
+            staged.append(StagedImage(filename, src_path, tags, thumb, prob_row, embed_row, *hashes))
+
+        now = datetime.now().isoformat()
+        conn.executemany(SQL['journal_infer'], (
+            (json.dumps(item.tags), item.prob_row, item.embed_row[0] if item.embed_row else None, now, src_path)
+            for item, src_path in zip(staged, src_paths)))
+        conn.commit()
+        for item in staged:
+            self._stage(conn, total, stats, item)
+
+    def _stage(self, conn, total, stats, item):
+        """暂存一张已推理的图片，攒够 COMMIT_INTERVAL 张时一起写库"""
+        self._staged.append(item)
+        if len(self._staged) >= COMMIT_INTERVAL:
+            self._flush(conn, total, stats)
+
+    def _flush(self, conn, total, stats):
+        """在一个事务中写入全部暂存图片，提交后移入归档目录，再更新内存索引与缩略图
+
+        每张图片的写库包在一个保存点内，失败时只撤销这一张（文件留在输入目录）。入库日志
+        与记录一同提交为 committed，归档后记为 moved: 两步之间中断时，下次处理或完整性修复
+        按日志补做归档（见 finish_interrupted_moves()）；提交失败时整组回滚，日志仍为 inferred。
+        """
+        staged, self._staged = self._staged, []
+        if not staged:
+            return
+
+        cursor = conn.cursor()
+        stored = []
+        reserved = set()    # 本组已分配的归档文件名，文件提交后才移动，不能只看磁盘
+        for item in staged:
+            try:
+                stored.append(self._store_result(cursor, item, reserved))
+            except Exception as e:
+                self.on_error(f"处理失败: {item.filename}\n{str(e)}")
+        try:
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            names = ", ".join(item.filename for item in staged)
+            self.on_error(f"写入数据库失败: {names}\n{str(e)}")
+            return
+
+        moved = []
+        for result in stored:
+            try:
+                shutil.move(result.item.src_path, result.dest_path)
+                moved.append((datetime.now().isoformat(), os.path.abspath(result.item.src_path)))
+            except Exception as e:
+                # 记录已提交，日志保持 committed，下次处理时再归档
+                self.on_error(f"归档失败: {result.name}\n{str(e)}")
+        cursor.executemany(SQL['journal_moved'], moved)
+        conn.commit()
+
+        for result in stored:
+            self._after_commit(result, stats)
+            status_msg = f"处理中: {result.item.filename}"
+            if result.name != result.item.filename:
+                status_msg += f" -> {result.name}"
+            # 解码线程按完成顺序交付，进度按已归档张数计算
+            self.on_progress(stats['done'], total, status_msg)
+
+        self.thumb_store.commit()
+        self.on_batch()
+
+    def _store_result(self, cursor, item, reserved):
+        """在当前事务中写入一张暂存图片的元数据与标签，返回 StoredImage（文件由 _flush() 提交后移动）
+
+        图片行用 UPSERT 写入，覆盖同名旧记录时沿用原 ID，只替换其标签与向量行号。
+        reserved 为本组已分配的归档文件名，分配到的文件名随之加入。
+        """
+        final_filename = unique_filename(item.filename, taken=reserved)
+        if final_filename != item.filename:
+            print(f"重名处理: {item.filename} -> {final_filename}")
+        dest_path = os.path.join(ARCHIVE_FOLDER, final_filename)
+
+        tag_deltas = Counter(name for _, name, _ in item.tags)
+        cursor.execute("SAVEPOINT store_image")
+        try:
+            row = cursor.execute(SQL['image_id'], (final_filename,)).fetchone()
+            if row:
+                tag_deltas.subtract(name for name, in cursor.execute(SQL['image_tag_names'], row).fetchall())
+                cursor.execute(SQL['clear_image_tags'], row)
+                if item.prob_row is None:
+                    cursor.execute(SQL['delete_image_prob_id'], row)
+                if item.embed_row is None:
+                    cursor.execute(SQL['delete_image_embedding_id'], row)
+
+            cursor.execute(SQL['upsert_image'],
+                           (final_filename, os.path.getsize(item.src_path),
+                            datetime.now().isoformat(), item.content_hash, item.phash))
+            image_id = row[0] if row else cursor.lastrowid
+            rows = [(image_id, tag_id, round(conf, 5)) for tag_id, _, conf in item.tags]
+            cursor.executemany(SQL['insert_image_tags'], rows)
+            if item.prob_row is not None:
+                cursor.execute(SQL['insert_image_prob'], (image_id, item.prob_row))
+            if item.embed_row is not None:
+                cursor.execute(SQL['insert_image_embedding'], (image_id, item.embed_row[0]))
+            cursor.execute(SQL['journal_commit'], (os.path.abspath(item.src_path), item.content_hash, item.phash,
+                                                   final_filename, datetime.now().isoformat()))
+            cursor.execute("RELEASE store_image")
+        except Exception:
+            cursor.execute("ROLLBACK TO store_image")
+            cursor.execute("RELEASE store_image")
+            raise
+        reserved.add(final_filename)
+        return StoredImage(item, final_filename, dest_path, image_id, row is not None, tag_deltas, rows)
+
+    def _after_commit(self, result, stats):
+        """写库提交后: 同步内存索引、去重状态与缩略图缓存"""
+        item = result.item
+        stats['done'] += 1
+        stats['renamed'] += result.name != item.filename
+        stats['overwritten'] += result.replaced
+
+        if self.tag_index is not None:
+            self.tag_index.adjust(result.tag_deltas)
+        if self.tag_bitmaps is not None:
+            if result.replaced:
+                self.tag_bitmaps.remove(result.image_id)
+            self.tag_bitmaps.add(result.image_id, [(tag_id, conf) for _, tag_id, conf in result.tag_rows])
+        if self.similarity_index is not None:
+            if result.replaced:
+                self.similarity_index.remove(result.image_id)
+            if item.embed_row is not None:
+                self.similarity_index.add(result.image_id, item.embed_row[1])
+        if item.content_hash is not None:
+            self._known_hashes[item.content_hash] = result.name
+        self._check_near_duplicate(result.name, item.phash)
+
+        # 移动保留 mtime，按归档后的文件建键，浏览时可直接命中
+        if item.thumb is not None:
+            try:
+                self.thumb_store.put(result.name, result.dest_path, data=item.thumb, commit=False)
+            except Exception as e:
+                print(f"缩略图缓存写入失败: {result.name} - {str(e)}")
+
+
+# ── 命令行 ────────────────────────────────────────────────
+
+def ingest_command(input_folder=INPUT_FOLDER, workers=DECODE_WORKERS, watch=False, batch_delay=WATCH_BATCH_DELAY):
+    """无界面入库，返回进程退出码
+
+    进度以 JSON Lines 逐行写到标准输出，每行一个事件:
+        {"event": "progress", "done": 3, "total": 120, "message": "处理中: a.jpg"}
+        {"event": "error", "message": "..."}
+        {"event": "near_duplicate", "name": "新图片", "similar_to": "已有图片", "distance": 4}
+        {"event": "done", "total": 120, "done": 118, ..., "summary": "处理完成! ..."}
+    watch=True 时持续监视输入目录（见 IngestEngine.watch()），每个微批次结束输出一个 done 事件，
+    退出时输出 {"event": "stopped"}。模型加载等其余日志写到标准错误。
+    Ctrl+C / SIGTERM 时处理完当前批次后退出，未推理的图片保留在输入目录。
+    """
+    out = sys.stdout
+    out_lock = threading.Lock()
+
+    def emit(event, **fields):
+        with out_lock:
+            out.write(json.dumps({'event': event, **fields}, ensure_ascii=False) + '\n')
+            out.flush()
+
+    with contextlib.redirect_stdout(sys.stderr):
+        if not os.path.isdir(input_folder):
+            emit('error', message=f"输入文件夹 {input_folder} 不存在")
+            return 1
+        try:
+            print("正在加载模型...")
+            tagger = WDTagger()
+            print("模型加载完成！")
+        except Exception as e:
+            emit('error', message=f"模型加载失败: {e}")
+            return 1
+
+        thumb_store = ThumbnailStore()
+        engine = IngestEngine(
+            tagger, thumb_store, workers=workers,
+            on_progress=lambda done, total, message: emit('progress', done=done, total=total, message=message),
+            on_error=lambda message: emit('error', message=message))
+        if BITMAP_INDEX:
+            # 随入库增量更新并在结束时保存，界面下次启动无需重建
+            cursor = engine.db.writer.cursor()
+            prepare_database(cursor)
+            engine.db.writer.commit()
+            engine.tag_bitmaps = TagBitmapIndex()
+            engine.tag_bitmaps.load(cursor)
+
+        stats = {}
+
+        def report(run_stats):
+            for name, similar_to, distance in run_stats['near_duplicates']:
+                emit('near_duplicate', name=name, similar_to=similar_to, distance=distance)
+            emit('done', **{key: value for key, value in run_stats.items() if key != 'near_duplicates'},
+                 near_duplicates=len(run_stats['near_duplicates']), summary=engine.summary(run_stats))
+
+        def work():
+            try:
+                if watch:
+                    engine.watch(input_folder, batch_delay, on_run=report)
+                    stats['cancelled'] = False
+                else:
+                    stats.update(engine.run(input_folder))
+                    report(stats)
+            except Exception as e:
+                emit('error', message=f"入库失败: {e}")
+
+        # 推理放在工作线程，主线程只等待并接收中断信号
+        signal.signal(signal.SIGTERM, lambda signum, frame: engine.stop_event.set())
+        worker = threading.Thread(target=work)
+        worker.start()
+        try:
+            while worker.is_alive():
+                worker.join(0.5)
+        except KeyboardInterrupt:
+            engine.stop_event.set()
+            worker.join()
+        finally:
+            thumb_store.close()
+            engine.db.close()
+
+    if not stats:
+        return 1
+    if watch:
+        emit('stopped')
+    return 1 if stats['cancelled'] else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tagify", description="Tagify 无界面命令（读取 app_config.json）")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ingest = commands.add_parser('ingest', help="为输入目录中的图片打标签并移入归档目录，进度以 JSON Lines 输出")
+    ingest.add_argument('--input', default=INPUT_FOLDER, help=f"输入目录（默认 {INPUT_FOLDER}）")
+    ingest.add_argument('--workers', type=int, default=DECODE_WORKERS,
+                        help=f"解码线程数（默认 {DECODE_WORKERS}）")
+
+    watch = commands.add_parser('watch', help="持续监视输入目录，新图片写完后自动入库（模型常驻内存）")
+    watch.add_argument('--input', default=INPUT_FOLDER, help=f"输入目录（默认 {INPUT_FOLDER}）")
+    watch.add_argument('--workers', type=int, default=DECODE_WORKERS,
+                       help=f"解码线程数（默认 {DECODE_WORKERS}）")
+    watch.add_argument('--batch-delay', type=float, default=WATCH_BATCH_DELAY,
+                       help=f"新图片最多等待多少秒凑成一批（默认 {WATCH_BATCH_DELAY}）")
+
+    commands.add_parser('explain', help="输出所有查询的 EXPLAIN QUERY PLAN")
+    commands.add_parser('rebuild-tag-stats', help="按 image_tags 重建 tag_stats")
+    commands.add_parser('backfill-hashes', help="为旧图片补算内容哈希与感知哈希")
+    repair = commands.add_parser('repair', help="修复中断入库留下的不一致: 补做归档、删除缺少文件的记录、"
+                                               "把没有记录的图片移回输入目录")
+    repair.add_argument('--input', default=INPUT_FOLDER, help=f"输入目录（默认 {INPUT_FOLDER}）")
+    rethreshold_parser = commands.add_parser('rethreshold', help="按已保存的概率向量以新阈值重新生成标签")
+    rethreshold_parser.add_argument('threshold', type=float, nargs='?', default=PROCESS_THRESHOLD)
+
+    args = parser.parse_args(argv)
+    if args.command == 'ingest':
+        return ingest_command(args.input, args.workers)
+    if args.command == 'watch':
+        return ingest_command(args.input, args.workers, watch=True, batch_delay=args.batch_delay)
+    if args.command == 'explain':
+        explain_queries()
+    elif args.command == 'rebuild-tag-stats':
+        rebuild_tag_stats_command()
+    elif args.command == 'backfill-hashes':
+        backfill_hashes()
+    elif args.command == 'repair':
+        repair_command(args.input)
+    elif args.command == 'rethreshold':
+        rethreshold(args.threshold)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())